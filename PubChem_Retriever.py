@@ -1,23 +1,30 @@
 # Import libraries, packages, and functions
+# Heavier optional packages (tkinter, openpyxl, pyarrow) are imported by the functions that need them
 import pandas as pd
-import pubchempy as pcp
-import tkinter as tk
-from tkinter import Tk, filedialog, simpledialog
 import os
 import re
+import sys
+import csv
+import glob
+import gzip
+import json
+import queue
+import sqlite3
+import shutil
+import tempfile
+import zlib
+import argparse
+import subprocess
+import itertools
 import time
+import random
 import requests
+from requests.adapters import HTTPAdapter
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from datetime import datetime
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-import openpyxl
-from openpyxl import load_workbook
-from openpyxl.styles import Alignment
-from openpyxl.utils import get_column_letter
-from openpyxl.formatting.rule import ColorScaleRule, CellIsRule
-from openpyxl.worksheet.dimensions import ColumnDimension
 
 # Toggles
 def prompt_user(question):
@@ -32,44 +39,457 @@ def prompt_user(question):
         else:
             print("Invalid input. Please enter 1 for Yes or 2 for No.")
 
-# Interactive prompts for data retrieval options
-RETRIEVE_INCHIKEY = prompt_user("Would you like to retrieve InChIKeys from PubChem?")
-RETRIEVE_CAS = prompt_user("Would you like to retrieve CAS# from PubChem?")
-RETRIEVE_SMILES = prompt_user("Would you like to retrieve SMILES from PubChem?")
-RETRIEVE_DTXSID = prompt_user("Would you like to retrieve DSSTox SID from PubChem?")
-RETRIEVE_USES = prompt_user("Would you like to retrieve Uses & Use Classification from PubChem?")
-RETRIEVE_CLASSYFIRE = prompt_user("Would you like to retrieve chemical class data from ClassyFire Batch?")
+# Data retrieval options
+@dataclass
+class RetrievalOptions:
+    """
+    Data to retrieve for each compound, and the input column used to search PubChem:
+    'name', 'inchikey', or None to use 'Name' if the table has it and 'InChIKey' otherwise.
+    """
+    inchikey: bool = True
+    cas: bool = True
+    smiles: bool = True
+    dtxsid: bool = False
+    uses: bool = False
+    classyfire: bool = False
+    input_column: str = None
+
+# A function to ask for the data retrieval options interactively
+def prompt_options():
+    return RetrievalOptions(
+        inchikey=prompt_user("Would you like to retrieve InChIKeys from PubChem?"),
+        cas=prompt_user("Would you like to retrieve CAS# from PubChem?"),
+        smiles=prompt_user("Would you like to retrieve SMILES from PubChem?"),
+        dtxsid=prompt_user("Would you like to retrieve DSSTox SID from PubChem?"),
+        uses=prompt_user("Would you like to retrieve Uses & Use Classification from PubChem?"),
+        classyfire=prompt_user("Would you like to retrieve chemical class data from ClassyFire Batch?"),
+    )
+
+# PubChem service endpoints
+PUG_REST_URL = "https://pubchem.ncbi.nlm.nih.gov/rest/pug"
+PUG_VIEW_URL = "https://pubchem.ncbi.nlm.nih.gov/rest/pug_view"
+
+# Batched PUG REST lookups: rows are resolved in chunks of BATCH_SIZE identifiers per request
+BATCH_MODE = True
+BATCH_SIZE = 100
+
+# Number of PUG-View records kept in memory, so that CAS, DTXSID and Uses extraction share a single download per CID
+PUGVIEW_STORE_SIZE = 32
+
+# PUG-View retrieval mode: 'heading' requests only the heading each enabled option needs (CAS, DSSTox Substance ID,
+# Use and Manufacturing), which keeps payloads small for compounds with large records; 'full' downloads the whole record once,
+# which takes fewer requests when several of CAS, DTXSID and Uses are enabled; 'auto' picks 'heading' when only one
+# of them is enabled and 'full' otherwise, so that every CID costs at most one PUG-View request
+PUGVIEW_MODE = 'auto'
+
+# Concurrent retrieval: rows are processed by MAX_WORKERS threads, while all PubChem requests together
+# stay within the published limits of 5 requests per second and 400 requests per minute
+MAX_WORKERS = 8
+PUBCHEM_RATE_LIMITS = [(5, 1), (400, 60)]
+
+# HTTP session shared by all requests: (connect, read) timeouts in seconds and number of pooled keep-alive connections
+REQUEST_TIMEOUT = (5, 30)
+BATCH_TIMEOUT = (5, 60)
+POOL_SIZE = MAX_WORKERS
+
+# Retries of transient PubChem errors (busy server, timeouts, dropped connections) with jittered exponential backoff
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0
+RETRY_BACKOFF_MAX = 60.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Request rate, as a fraction of PUBCHEM_RATE_LIMITS, for the worst status reported in the X-Throttling-Control header
+THROTTLING_SCALES = {'green': 1.0, 'yellow': 0.5, 'red': 0.25, 'black': 0.1}
+
+# ClassyFire Batch endpoint, queried once per InChIKey by CLASSYFIRE_WORKERS threads under CLASSYFIRE_RATE_LIMITS
+CLASSYFIRE_URL = "https://cfb.fiehnlab.ucdavis.edu/entities/{inchikey}.json"
+CLASSYFIRE_WORKERS = 4
+CLASSYFIRE_RATE_LIMITS = [(10, 1)]
+
+# Pipelined retrieval: identifiers flow through bounded queues from the batched CID and property requests (BATCH_SIZE
+# identifiers at a time) to the per-compound lookups (MAX_WORKERS threads) and on to ClassyFire (CLASSYFIRE_WORKERS
+# threads), so that each stage starts on a compound as soon as its inputs are ready; up to PIPELINE_QUEUE_SIZE items
+# wait between two stages
+PIPELINE_QUEUE_SIZE = 2 * BATCH_SIZE
+
+# Optional local cache of PubChem results shared between runs; set CACHE_PATH, e.g. "pubchem_cache.sqlite", to enable it
+CACHE_PATH = None
+CACHE_TTL_DAYS = 30
+CACHE_MAX_ENTRIES = 500000
+
+# A token-bucket rate limiter
+class RateLimiter:
+    """
+    Token-bucket limiter enforcing several (requests, seconds) limits at once, shared by all worker threads.
+    acquire() blocks until a request may be sent under every limit; scale slows all limits down, e.g. 0.5 halves the rate.
+    """
+    def __init__(self, limits):
+        self.limits = [(float(n), float(period)) for n, period in limits]
+        self.tokens = [n for n, _ in self.limits]
+        self.scale = 1.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_scale(self, scale):
+        with self.lock:
+            self.scale = min(1.0, max(0.01, scale))
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.updated
+                self.updated = now
+                self.tokens = [min(n, t + elapsed * self.scale * n / period) for t, (n, period) in zip(self.tokens, self.limits)]
+                if all(t >= 1 for t in self.tokens):
+                    self.tokens = [t - 1 for t in self.tokens]
+                    return
+                wait = max((1 - t) * period / (n * self.scale) for t, (n, period) in zip(self.tokens, self.limits) if t < 1)
+            time.sleep(wait)
+
+_pubchem_limiter = RateLimiter(PUBCHEM_RATE_LIMITS)
+
+# A function to get the shared HTTP session
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """
+    Return the HTTP session shared by every fetcher, created on first use.
+    Its connection pool keeps up to POOL_SIZE connections per host alive, so requests reuse
+    TCP and TLS connections instead of opening a new one per call; responses are gzip-compressed.
+    Retries are handled by http_request, not by the adapter.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                'Accept-Encoding': 'gzip, deflate',
+                'Connection': 'keep-alive',
+                'User-Agent': 'PubChem_Retriever (python-requests)',
+            })
+            _session = session
+    return _session
+
+# Per-thread count of failed requests, used to tell complete lookups from ones that lost data to errors
+_thread_state = threading.local()
+
+def thread_failures():
+    return getattr(_thread_state, 'failures', 0)
+
+# Upper bounds, in seconds, of the latency histogram buckets kept for each endpoint
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Per-endpoint request metrics
+class Metrics:
+    """
+    Thread-safe per-endpoint metrics of outbound requests: requests, retries, failures, response status codes,
+    latency histogram (LATENCY_BUCKETS), bytes received on the wire, time spent in requests and waiting for the rate limiter;
+    and hits and misses of the local cache and index by kind. summary() returns them as a JSON-ready dict,
+    totals() the requests, retries and failures summed over endpoints.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.lookups = {}
+            self.started = time.time()
+
+    def _endpoint(self, endpoint):
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {'requests': 0, 'retried': 0, 'failed': 0, 'errors': 0, 'status': {},
+                                        'bytes': 0, 'seconds': 0.0, 'wait_seconds': 0.0,
+                                        'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+        return self.endpoints[endpoint]
+
+    def record_request(self, endpoint, seconds, wait_seconds, status=None, nbytes=0):
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        with self.lock:
+            stats = self._endpoint(endpoint)
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+            stats['wait_seconds'] += wait_seconds
+            stats['bytes'] += nbytes
+            stats['histogram'][bucket] += 1
+            if status is None:
+                stats['errors'] += 1
+            else:
+                stats['status'][str(status)] = stats['status'].get(str(status), 0) + 1
+
+    def count(self, endpoint, key):
+        with self.lock:
+            self._endpoint(endpoint)[key] += 1
+
+    def totals(self, exclude=()):
+        with self.lock:
+            return {key: sum(stats[key] for endpoint, stats in self.endpoints.items() if endpoint not in exclude)
+                    for key in ('requests', 'retried', 'failed')}
+
+    def record_lookup(self, source, kind, hit):
+        with self.lock:
+            stats = self.lookups.setdefault(f"{source}:{kind}", {'hits': 0, 'misses': 0})
+            stats['hits' if hit else 'misses'] += 1
+
+    def summary(self):
+        labels = [f"<={bound}s" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+        with self.lock:
+            endpoints = {}
+            total = sum(stats['seconds'] for stats in self.endpoints.values()) or 1.0
+            for endpoint, stats in sorted(self.endpoints.items()):
+                endpoints[endpoint] = dict(
+                    {k: v for k, v in stats.items() if k != 'histogram'},
+                    mean_seconds=stats['seconds'] / stats['requests'] if stats['requests'] else 0.0,
+                    share_of_request_time=stats['seconds'] / total,
+                    latency_histogram=dict(zip(labels, stats['histogram'])),
+                )
+            return {'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                    'elapsed_seconds': time.time() - self.started,
+                    'endpoints': endpoints,
+                    'lookups': {k: dict(v) for k, v in sorted(self.lookups.items())}}
+
+METRICS = Metrics()
+
+# A function to save the metrics summary as JSON
+def write_metrics(path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(METRICS.summary(), f, indent=2)
+    print(f"Request metrics saved to: {path}")
+    print("-"*150)
+
+# A function to adapt the request rate to the load PubChem reports
+def apply_throttling_control(header):
+    """
+    Parse the X-Throttling-Control header, e.g.
+    "Request Count status: Green (0%), Request Time status: Yellow (60%), Service status: Green (20%)",
+    and adjust the shared rate limiter: the rate drops at once to the level of the worst status,
+    and recovers gradually while every status is Green.
+    """
+    statuses = re.findall(r'status:\s*(\w+)', header or '')
+    if not statuses:
+        return
+    target = min(THROTTLING_SCALES.get(status.lower(), 1.0) for status in statuses)
+    current = _pubchem_limiter.scale
+    if target < current:
+        _pubchem_limiter.set_scale(target)
+    elif current < target:
+        _pubchem_limiter.set_scale(current + 0.1 * target)
+
+# A function to send rate-limited requests with retries
+def http_request(method, url, limiter=None, endpoint='other', **kwargs):
+    """
+    Send a request under the given rate limiter, e.g. the one shared by all PubChem requests,
+    and record it in METRICS under the given endpoint name.
+    Busy-server responses, timeouts and connection errors are retried up to MAX_RETRIES times with
+    jittered exponential backoff (or the server's Retry-After delay). Requests go through the shared session
+    and use REQUEST_TIMEOUT unless a timeout is given. Other responses, including 404,
+    are returned as they are; the last response or error is returned or raised once retries are exhausted.
+    """
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    session = get_session()
+    for attempt in range(MAX_RETRIES + 1):
+        waited = time.perf_counter()
+        if limiter is not None:
+            limiter.acquire()
+        started = time.perf_counter()
+        try:
+            res = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            res, error = None, e
+            METRICS.record_request(endpoint, time.perf_counter() - started, started - waited)
+        else:
+            error = None
+            # Bodies are measured as received on the wire, i.e. compressed if the server compressed them:
+            # read bodies by the bytes pulled from the connection, streamed ones, not read yet, by their header
+            nbytes = int(res.headers.get('Content-Length') or 0) if kwargs.get('stream') else res.raw.tell()
+            METRICS.record_request(endpoint, time.perf_counter() - started, started - waited, res.status_code, nbytes)
+            if limiter is _pubchem_limiter:
+                apply_throttling_control(res.headers.get('X-Throttling-Control'))
+            if res.status_code not in RETRY_STATUS_CODES:
+                return res
+            if limiter is not None and res.status_code in (429, 503):
+                limiter.set_scale(limiter.scale / 2)
+
+        if attempt == MAX_RETRIES:
+            METRICS.count(endpoint, 'failed')
+            _thread_state.failures = thread_failures() + 1
+            if error is not None:
+                raise error
+            return res
+
+        METRICS.count(endpoint, 'retried')
+        delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt))
+        retry_after = res.headers.get('Retry-After') if res is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        if res is not None:
+            # Release the pooled connection of a discarded (possibly streamed) response before waiting
+            res.close()
+        time.sleep(delay)
+
+def pubchem_get(url, endpoint='pubchem', **kwargs):
+    return http_request('GET', url, limiter=_pubchem_limiter, endpoint=endpoint, **kwargs)
+
+def pubchem_post(url, endpoint='pubchem', **kwargs):
+    return http_request('POST', url, limiter=_pubchem_limiter, endpoint=endpoint, **kwargs)
+
+_classyfire_limiter = RateLimiter(CLASSYFIRE_RATE_LIMITS)
+
+# A function to give this process its share of the request rates, when several processes query PubChem together
+def share_rate_limits(shares):
+    """
+    Divide PUBCHEM_RATE_LIMITS and CLASSYFIRE_RATE_LIMITS among shares processes, so that together they stay within
+    the published rates. A limit below one request per period becomes one request per proportionally longer period.
+    """
+    global _pubchem_limiter, _classyfire_limiter
+
+    def divide(limits):
+        return [(n / shares, period) if n >= shares else (1, period * shares / n) for n, period in limits]
+
+    _pubchem_limiter = RateLimiter(divide(PUBCHEM_RATE_LIMITS))
+    _classyfire_limiter = RateLimiter(divide(CLASSYFIRE_RATE_LIMITS))
 
+def classyfire_get(url, **kwargs):
+    return http_request('GET', url, limiter=_classyfire_limiter, endpoint='classyfire', **kwargs)
 
-def get_pubchem_info(identifier, input_type='name', retrieve_inchikey=True, retrieve_cas=True, retrieve_smiles=True):
+# Optional offline index of PubChem identifiers built from the bulk CID-InChI-Key, CID-SMILES and CID-Synonym files
+# (https://ftp.ncbi.nlm.nih.gov/pubchem/Compound/Extras/); set INDEX_PATH to resolve CIDs, InChIKeys and SMILES
+# locally first and only query PubChem for identifiers the index does not have
+INDEX_PATH = None
+
+# A marker for values that are not in the cache, as None is a valid (negative) cached result
+_MISS = object()
+
+# A persistent cache of PubChem results
+class ResponseCache:
+    """
+    SQLite-backed cache of identifier-to-CID mappings, properties and extracted CAS, DTXSID and Uses values.
+    Negative lookups are cached as None. Entries expire after ttl_days, except ClassyFire classifications,
+    which do not change for a given InChIKey; InChIKeys ClassyFire has not classified (cached as None) do expire,
+    since they may be classified later. The least recently used entries are evicted once the cache
+    holds more than max_entries.
+    """
+    PERMANENT_KINDS = ('classyfire',)
+
+    def __init__(self, path, ttl_days=CACHE_TTL_DAYS, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl_days * 86400
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT, created REAL NOT NULL, accessed REAL NOT NULL, "
+            "PRIMARY KEY (kind, key))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self.conn.execute(
+            f"DELETE FROM cache WHERE created < ? AND (kind NOT IN ({','.join('?' * len(self.PERMANENT_KINDS))}) "
+            "OR value = 'null')",
+            (time.time() - self.ttl, *self.PERMANENT_KINDS)
+        )
+        self.hits = self.misses = 0
+        self._writes = 0
+
+    def get(self, kind, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value, created FROM cache WHERE kind = ? AND key = ?", (kind, str(key))).fetchone()
+            now = time.time()
+            expired = row is not None and row[1] < now - self.ttl and (kind not in self.PERMANENT_KINDS or row[0] == 'null')
+            if row is None or expired:
+                self.misses += 1
+                return _MISS
+            self.conn.execute("UPDATE cache SET accessed = ? WHERE kind = ? AND key = ?", (now, kind, str(key)))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, kind, key, value):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (kind, key, value, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (kind, str(key), json.dumps(value), now, now)
+            )
+            # Check the size limit every 1000 writes rather than on every insert
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._evict()
+
+    def evict(self):
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def close(self):
+        self.evict()
+        self.conn.close()
+
+_cache = None
+
+# Functions to open and close the local cache
+def open_cache(path=None):
+    global _cache
+    close_cache()
+    _cache = ResponseCache(path or CACHE_PATH)
+    return _cache
+
+def close_cache():
+    global _cache
+    if _cache is not None:
+        _cache.close()
+        _cache = None
+
+# Functions to read from and write to the local cache; both do nothing if the cache is disabled
+def cache_get(kind, key):
+    if _cache is None:
+        return _MISS
+    value = _cache.get(kind, key)
+    METRICS.record_lookup('cache', kind, value is not _MISS)
+    return value
+
+def cache_set(kind, key, value):
+    if _cache is not None:
+        _cache.set(kind, key, value)
+
+
+def get_pubchem_info(identifier, input_type='name', retrieve_inchikey=True, retrieve_cas=True, retrieve_smiles=True, cid=None,
+                     full_record=False):
     """
     Retrieve InChIKey, CAS, and SMILES using PubChem property API based on CID,
-    which is obtained from either name or InChIKey.
+    which is obtained from either name or InChIKey unless already resolved and passed as cid.
     """
     try:
         # First get PubChem CID
-        if input_type == 'name':
-            url_cid = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{identifier}/cids/JSON"
-        else:
-            url_cid = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/inchikey/{identifier}/cids/JSON"
-        res = requests.get(url_cid, timeout=10)
-        res.raise_for_status()
-        cids = res.json().get('IdentifierList', {}).get('CID', [])
-        if not cids:
+        if cid is None:
+            cid = get_pubchem_cid(identifier, input_type)
+        if cid is None:
             return None, None, None
-        cid = cids[0]
 
         # Fetch properties including SMILES and InChIKey
-        prop_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{cid}/property/InChIKey,SMILES/JSON"
-        prop_res = requests.get(prop_url, timeout=10)
-        prop_res.raise_for_status()
-        props = prop_res.json().get('PropertyTable', {}).get('Properties', [{}])[0]
+        props = {}
+        if retrieve_inchikey or retrieve_smiles:
+            props = get_pubchem_properties(cid)
 
         inchikey = props.get('InChIKey') if retrieve_inchikey else None
         smiles = props.get('SMILES') if retrieve_smiles else None
 
         # CAS number via PUG-View
-        cas = get_cas(cid) if retrieve_cas else None
+        cas = get_cas(cid, full_record=full_record) if retrieve_cas else None
 
         return inchikey, cas, smiles
 
@@ -77,130 +497,827 @@ def get_pubchem_info(identifier, input_type='name', retrieve_inchikey=True, retr
         print(f"Error fetching for '{identifier}' ({input_type}): {e}")
         return None, None, None
 
-# A function to get CAS number
-def get_cas(cid):
+# An offline index of PubChem identifiers
+class LocalIndex:
+    """
+    Read-only SQLite index mapping InChIKeys and case-folded synonyms to CIDs, and CIDs to InChIKey and SMILES,
+    built by build_local_index. Where several CIDs share an InChIKey or a synonym, the lowest CID is kept.
+    """
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise ValueError(f"Local index not found: {path}")
+        self.path = path
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def lookup_cid(self, identifier, input_type='name'):
+        if input_type == 'inchikey':
+            query, key = "SELECT cid FROM inchikey WHERE inchikey = ?", identifier.strip().upper()
+        else:
+            query, key = "SELECT cid FROM synonym WHERE name = ?", identifier.strip().casefold()
+        with self.lock:
+            row = self.conn.execute(query, (key,)).fetchone()
+        self._count(f"{input_type}_cid", row)
+        return row[0] if row else None
+
+    def properties(self, cid):
+        with self.lock:
+            row = self.conn.execute("SELECT inchikey, smiles FROM compound WHERE cid = ?", (cid,)).fetchone()
+        # Only complete rows are used; otherwise the properties are fetched from PubChem
+        if row is None or row[0] is None or row[1] is None:
+            self._count('properties', None)
+            return None
+        self._count('properties', row)
+        return {'CID': cid, 'InChIKey': row[0], 'SMILES': row[1]}
+
+    def _count(self, kind, row):
+        METRICS.record_lookup('index', kind, row is not None)
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+    def close(self):
+        self.conn.close()
+
+_index = None
+
+# Functions to open and close the local index
+def open_index(path=None):
+    global _index
+    close_index()
+    _index = LocalIndex(path or INDEX_PATH)
+    return _index
+
+def close_index():
+    global _index
+    if _index is not None:
+        _index.close()
+        _index = None
+
+# A function to read the rows of a tab-separated PubChem bulk file, gzipped or not
+def _read_bulk_file(path, n_fields):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= n_fields and fields[0].isdigit():
+                yield fields
+
+# A function to build the local index from PubChem bulk files
+def build_local_index(index_path, cid_inchikey=None, cid_smiles=None, cid_synonym=None, batch_size=100000):
     """
-    Retrieve CAS number using PubChem PUG-View and recursive heading search.
+    Build the SQLite index used by LocalIndex from the PubChem bulk files CID-InChI-Key (CID, InChI, InChIKey),
+    CID-SMILES (CID, SMILES) and CID-Synonym-filtered (CID, synonym); any of them may be left out.
+    Lookup tables are filled from unsorted staging tables in a single sorted pass, which is much faster than
+    inserting hundreds of millions of rows into an indexed table.
     """
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    conn = sqlite3.connect(index_path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("CREATE TABLE compound (cid INTEGER PRIMARY KEY, inchikey TEXT, smiles TEXT)")
+    conn.execute("CREATE TEMP TABLE staging_inchikey (inchikey TEXT, cid INTEGER)")
+    conn.execute("CREATE TEMP TABLE staging_synonym (name TEXT, cid INTEGER)")
+
+    def load(path, n_fields, statements, row_values):
+        print(f"Reading {path}...")
+        batch, count = [], 0
+        conn.execute("BEGIN")
+        for fields in _read_bulk_file(path, n_fields):
+            batch.append(row_values(fields))
+            if len(batch) == batch_size:
+                for statement, values in statements:
+                    conn.executemany(statement, (values(row) for row in batch))
+                count += len(batch)
+                batch = []
+                if count % (10 * batch_size) == 0:
+                    print(f"{count} rows loaded")
+        for statement, values in statements:
+            conn.executemany(statement, (values(row) for row in batch))
+        conn.execute("COMMIT")
+        print(f"{count + len(batch)} rows loaded from {path}")
+        print("-"*150)
+
+    if cid_inchikey:
+        load(cid_inchikey, 3, [
+            ("INSERT INTO compound (cid, inchikey) VALUES (?, ?) ON CONFLICT (cid) DO UPDATE SET inchikey = excluded.inchikey",
+             lambda row: row),
+            ("INSERT INTO staging_inchikey (inchikey, cid) VALUES (?, ?)", lambda row: (row[1], row[0])),
+        ], lambda fields: (int(fields[0]), fields[2].strip().upper()))
+    if cid_smiles:
+        load(cid_smiles, 2, [
+            ("INSERT INTO compound (cid, smiles) VALUES (?, ?) ON CONFLICT (cid) DO UPDATE SET smiles = excluded.smiles",
+             lambda row: row),
+        ], lambda fields: (int(fields[0]), fields[1].strip()))
+    if cid_synonym:
+        load(cid_synonym, 2, [
+            ("INSERT INTO staging_synonym (name, cid) VALUES (?, ?)", lambda row: (row[1], row[0])),
+        ], lambda fields: (int(fields[0]), fields[1].strip().casefold()))
+
+    print("Building lookup tables...")
+    conn.execute("CREATE TABLE inchikey (inchikey TEXT PRIMARY KEY, cid INTEGER) WITHOUT ROWID")
+    conn.execute("INSERT INTO inchikey SELECT inchikey, MIN(cid) FROM staging_inchikey GROUP BY inchikey ORDER BY inchikey")
+    conn.execute("CREATE TABLE synonym (name TEXT PRIMARY KEY, cid INTEGER) WITHOUT ROWID")
+    conn.execute("INSERT INTO synonym SELECT name, MIN(cid) FROM staging_synonym GROUP BY name ORDER BY name")
+    conn.execute("DROP TABLE staging_inchikey")
+    conn.execute("DROP TABLE staging_synonym")
+    conn.execute("VACUUM")
+    conn.close()
+    print(f"Local index saved to: {index_path}")
+    print("-"*150)
+
+# A function to get InChIKey and SMILES of a PubChem CID
+def get_pubchem_properties(cid):
+    """
+    Retrieve InChIKey and SMILES properties of a CID from the local index or PUG REST.
+    Properties already fetched by prefetch_pubchem_batch are returned without a request.
+    """
+    if cid in _property_store:
+        return _property_store[cid]
+    # CIDs prefetch_pubchem_batch already missed in the index and cache are not looked up (or counted) again
+    if cid not in _property_misses:
+        props = _index.properties(cid) if _index is not None else None
+        if props is not None:
+            _property_store[cid] = props
+            return props
+        props = cache_get('properties', cid)
+        if props is not _MISS:
+            _property_store[cid] = props
+            return props
+    prop_url = f"{PUG_REST_URL}/compound/cid/{cid}/property/InChIKey,SMILES/JSON"
+    prop_res = pubchem_get(prop_url, endpoint='property')
+    prop_res.raise_for_status()
+    props = prop_res.json().get('PropertyTable', {}).get('Properties', [{}])[0]
+    _property_store[cid] = props
+    cache_set('properties', cid, props)
+    return props
+
+# Stores of resolved CIDs, keyed by (input_type, identifier), and of properties, keyed by CID, for one retrieve call
+_cid_store = {}
+_property_store = {}
+# Identifiers and CIDs already missed in the local index and cache during the call
+_cid_misses = set()
+_property_misses = set()
+
+# A function to resolve and fetch a chunk of identifiers with batched PUG REST requests
+def prefetch_pubchem_batch(identifiers, input_type='name', fetch_properties=True):
+    """
+    Resolve a chunk of identifiers to CIDs and fetch their InChIKey and SMILES with as few requests as possible.
+    InChIKeys are looked up together in one POST request, and the properties of all CIDs known so far are fetched
+    together in another (prefetch_pubchem_properties). Names can only be resolved one per request, so names missing
+    from the local index and cache are left to resolve_identifiers, which resolves them concurrently and then fetches
+    their properties in batches; anything the batch requests could not resolve is left to the per-item lookups.
+    Results are kept in the stores used by get_pubchem_cid and get_pubchem_properties.
+    """
+    pending = []
+    for x in dict.fromkeys(identifiers):
+        if (input_type, x) in _cid_store:
+            continue
+        cid = _index.lookup_cid(x, input_type) if _index is not None else None
+        if cid is not None:
+            _cid_store[(input_type, x)] = cid
+            continue
+        cid = cache_get('cid', f"{input_type}:{x}")
+        if cid is _MISS:
+            pending.append(x)
+            _cid_misses.add((input_type, x))
+        else:
+            _cid_store[(input_type, x)] = cid
+
+    if input_type == 'inchikey' and pending:
+        by_key = {}
+        for x in pending:
+            by_key.setdefault(x.strip().upper(), []).append(x)
+        try:
+            url = f"{PUG_REST_URL}/compound/inchikey/property/InChIKey,SMILES/JSON"
+            res = pubchem_post(url, data={'inchikey': ','.join(by_key)}, timeout=BATCH_TIMEOUT, endpoint='inchikey_batch')
+            if res.status_code == 200:
+                # Several CIDs may share an InChIKey; keep the first one, as the per-item lookup does
+                for props in res.json().get('PropertyTable', {}).get('Properties', []):
+                    for x in by_key.pop(props.get('InChIKey', ''), []):
+                        _cid_store[(input_type, x)] = props['CID']
+                        cache_set('cid', f"{input_type}:{x}", props['CID'])
+                        if props['CID'] not in _property_store:
+                            _property_store[props['CID']] = props
+                            cache_set('properties', props['CID'], props)
+            elif res.status_code != 404:
+                res.raise_for_status()
+        except Exception as e:
+            print(f"Batch InChIKey lookup failed for {len(pending)} identifiers, resolving one by one: {e}")
+
+    if fetch_properties:
+        prefetch_pubchem_properties([_cid_store.get((input_type, x)) for x in identifiers])
+
+# A function to fetch the InChIKey and SMILES of many CIDs with one PUG REST request
+def prefetch_pubchem_properties(cids):
+    """
+    Fetch the properties of the given CIDs that are not in the property store, the local index or the cache
+    with one POST request; None entries are skipped. CIDs the request could not fetch are left to get_pubchem_properties.
+    """
+    cids = [cid for cid in dict.fromkeys(cids) if cid is not None and cid not in _property_store]
+    for cid in list(cids):
+        props = _index.properties(cid) if _index is not None else None
+        if props is not None:
+            _property_store[cid] = props
+            cids.remove(cid)
+            continue
+        props = cache_get('properties', cid)
+        if props is not _MISS:
+            _property_store[cid] = props
+            cids.remove(cid)
+        else:
+            _property_misses.add(cid)
+    if not cids:
+        return
     try:
-        url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug_view/data/compound/{cid}/JSON"
-        res = requests.get(url, timeout=10)
+        url = f"{PUG_REST_URL}/compound/cid/property/InChIKey,SMILES/JSON"
+        res = pubchem_post(url, data={'cid': ','.join(str(cid) for cid in cids)}, timeout=BATCH_TIMEOUT,
+                           endpoint='property_batch')
         res.raise_for_status()
-        data = res.json()
-        sections = data.get('Record', {}).get('Section', [])
-        cas_list = extract_heading_info(sections, 'CAS')
-        for s in cas_list:
-            match = re.search(r'\d{2,7}-\d{2}-\d', s)
-            if match:
-                return match.group(0)
-    except:
-        pass
-    return None
+        for props in res.json().get('PropertyTable', {}).get('Properties', []):
+            _property_store[props['CID']] = props
+            cache_set('properties', props['CID'], props)
+    except Exception as e:
+        print(f"Batch property lookup failed for {len(cids)} CIDs, fetching one by one: {e}")
+
+# Headings extracted from PUG-View records, each given by its path of TOCHeadings; a heading matches wherever it is
+# nested below the earlier headings of its path. More headings can be added here and read with get_pugview_values
+PUGVIEW_HEADINGS = {
+    'CAS': ('CAS',),
+    'DSSTox Substance ID': ('DSSTox Substance ID',),
+    'Uses': ('Use and Manufacturing', 'Uses'),
+    'Use Classification': ('Use and Manufacturing', 'Use Classification'),
+}
+
+# Set to True to parse full PUG-View records incrementally with ijson (pip install ijson), so that only the values of
+# PUGVIEW_HEADINGS are kept in memory instead of the whole record. This saves memory on very large records but costs
+# more CPU than json on typical ones; single-heading responses are small and always parsed with json
+INCREMENTAL_JSON = False
+
+# A function to import the optional incremental JSON parser
+def _load_ijson():
+    if not INCREMENTAL_JSON:
+        return None
+    try:
+        import ijson
+    except ImportError:
+        return None
+    return ijson
+
+# A function to match a section against PUGVIEW_HEADINGS
+def _matching_headings(heading, ancestors, headings):
+    return [name for name, path in headings.items()
+            if heading == path[-1] and all(h in ancestors for h in path[:-1])]
+
+# A function to collect the strings of all requested headings from PUG-View sections
+def extract_headings(sections, headings=None):
+    """
+    Walk the section tree once, iteratively, and collect the StringWithMarkup strings of every heading in
+    headings (PUGVIEW_HEADINGS by default). Returns a dict of heading name -> list of strings, in document order.
+    """
+    headings = headings or PUGVIEW_HEADINGS
+    values = {name: [] for name in headings}
+    stack = [(section, ()) for section in reversed(sections)]
+    while stack:
+        section, ancestors = stack.pop()
+        heading = section.get("TOCHeading", "")
+        names = _matching_headings(heading, ancestors, headings)
+        if names:
+            for info in section.get("Information", []):
+                val_obj = info.get("Value", {})
+                if not isinstance(val_obj, dict):
+                    continue
+                for val in val_obj.get("StringWithMarkup", []):
+                    string = val.get("String", "")
+                    if string:
+                        for name in names:
+                            values[name].append(string)
+        subsections = section.get("Section")
+        if subsections:
+            ancestors = ancestors + (heading,)
+            stack.extend((sub, ancestors) for sub in reversed(subsections))
+    return values
+
+# A function to collect the strings of all requested headings from a streamed PUG-View response
+def extract_headings_incremental(stream, ijson, headings=None):
+    """
+    Same as extract_headings, but driven by ijson parse events, so the record is never built in memory.
+    Strings are buffered per open section until its TOCHeading is known, i.e. until the section ends.
+    """
+    headings = headings or PUGVIEW_HEADINGS
+    values = {name: [] for name in headings}
+    # One [heading, strings] frame per open section, outermost first
+    frames = []
+    for prefix, event, value in ijson.parse(stream):
+        if prefix.endswith('Section.item'):
+            if event == 'start_map':
+                frames.append(["", []])
+            elif event == 'end_map':
+                heading, strings = frames.pop()
+                names = _matching_headings(heading, tuple(f[0] for f in frames), headings)
+                for name in names:
+                    values[name] += strings
+        elif not frames:
+            continue
+        elif event == 'string' and prefix.endswith('Section.item.TOCHeading'):
+            frames[-1][0] = value
+        elif event == 'string' and prefix.endswith('Section.item.Information.item.Value.StringWithMarkup.item.String'):
+            if value:
+                frames[-1][1].append(value)
+    return values
+
+# A store of extracted PUG-View values of the most recent records, keyed by (CID, requested heading)
+_pugview_store = OrderedDict()
+_pugview_lock = threading.Lock()
+
+# A function to get the heading values of a PUG-View record
+def get_pugview_values(cid, heading=None):
+    """
+    Retrieve a compound's PUG-View record and extract all PUGVIEW_HEADINGS from it in one pass.
+    If a heading is given and PUGVIEW_MODE is not 'full', only that heading of the record is requested;
+    a record without the heading returns empty values, and any other failure falls back to the full record.
+    Each record is downloaded and parsed once and shared by get_cas, get_pubchem_uses and get_dtxsid;
+    the values of the most recently used records are kept, up to PUGVIEW_STORE_SIZE.
+    Returns None if the record could not be retrieved.
+    """
+    if cid is None:
+        return None
+    if PUGVIEW_MODE == 'full':
+        heading = None
+    with _pugview_lock:
+        if (cid, heading) in _pugview_store:
+            _pugview_store.move_to_end((cid, heading))
+            return _pugview_store[(cid, heading)]
+    ijson = _load_ijson() if heading is None else None
+    try:
+        url = f"{PUG_VIEW_URL}/data/compound/{cid}/JSON"
+        res = pubchem_get(url, params={'heading': heading} if heading else None, stream=ijson is not None,
+                          endpoint='pug_view')
+        if heading and res.status_code == 404:
+            values = {name: [] for name in PUGVIEW_HEADINGS}
+        else:
+            res.raise_for_status()
+            if ijson is not None:
+                res.raw.decode_content = True
+                values = extract_headings_incremental(res.raw, ijson)
+            else:
+                values = extract_headings(res.json().get('Record', {}).get('Section', []))
+        res.close()
+    except Exception as e:
+        if heading:
+            print(f"Error retrieving PUG-View heading '{heading}' for CID {cid}, using the full record: {e}")
+            return get_pugview_values(cid)
+        print(f"Error retrieving PUG-View record for CID {cid}: {e}")
+        values = None
+    with _pugview_lock:
+        _pugview_store[(cid, heading)] = values
+        while len(_pugview_store) > PUGVIEW_STORE_SIZE:
+            _pugview_store.popitem(last=False)
+    return values
+
+# A function to decide whether the PUG-View data of a compound is taken from its full record
+def use_full_record(options):
+    if PUGVIEW_MODE != 'auto':
+        return PUGVIEW_MODE == 'full'
+    return sum([options.cas, options.dtxsid, options.uses]) >= 2
+
+# A function to get CAS number
+def get_cas(cid, full_record=False):
+    """
+    Retrieve CAS number from the 'CAS' heading of the PubChem PUG-View record,
+    requesting only that heading unless full_record is set.
+    """
+    cas = cache_get('cas', cid)
+    if cas is not _MISS:
+        return cas
+    values = get_pugview_values(cid, None if full_record else 'CAS')
+    if values is None:
+        return None
+    cas = None
+    for s in values['CAS']:
+        match = re.search(r'\d{2,7}-\d{2}-\d', s)
+        if match:
+            cas = match.group(0)
+            break
+    cache_set('cas', cid, cas)
+    return cas
 
 # A function to get PubChem CID
 def get_pubchem_cid(identifier, input_type='name'):
+    """
+    Resolve a name or InChIKey to its first PubChem CID, from the local index if one is open.
+    Each row resolves its identifier once; the CID is then passed on to all other fetchers.
+    """
+    if (input_type, identifier) in _cid_store:
+        return _cid_store[(input_type, identifier)]
+    # Identifiers prefetch_pubchem_batch already missed in the index and cache are not looked up (or counted) again
+    if (input_type, identifier) not in _cid_misses:
+        cid = _index.lookup_cid(identifier, input_type) if _index is not None else None
+        if cid is not None:
+            _cid_store[(input_type, identifier)] = cid
+            return cid
+        cid = cache_get('cid', f"{input_type}:{identifier}")
+        if cid is not _MISS:
+            _cid_store[(input_type, identifier)] = cid
+            return cid
     try:
         if input_type == 'name':
-            url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{identifier}/cids/JSON"
+            url = f"{PUG_REST_URL}/compound/name/{identifier}/cids/JSON"
         elif input_type == 'inchikey':
-            url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/inchikey/{identifier}/cids/JSON"
+            url = f"{PUG_REST_URL}/compound/inchikey/{identifier}/cids/JSON"
         else:
             return None
 
-        res = requests.get(url)
+        res = pubchem_get(url, endpoint=f"{input_type}_cid")
         if res.status_code == 200:
-            return res.json()['IdentifierList']['CID'][0]
-    except:
-        pass
+            cids = res.json().get('IdentifierList', {}).get('CID', [])
+            _cid_store[(input_type, identifier)] = cids[0] if cids else None
+            cache_set('cid', f"{input_type}:{identifier}", _cid_store[(input_type, identifier)])
+            return _cid_store[(input_type, identifier)]
+        if res.status_code == 404:
+            _cid_store[(input_type, identifier)] = None
+            cache_set('cid', f"{input_type}:{identifier}", None)
+            return None
+        res.raise_for_status()
+    except Exception as e:
+        print(f"Error resolving CID for '{identifier}' ({input_type}): {e}")
     return None
 
-# A function to get PubChem heading information
-def extract_heading_info(sections, target_heading):
-    results = []
-    for section in sections:
-        if section.get("TOCHeading") == target_heading:
-            for info in section.get("Information", []):
-                for val in info.get("Value", {}).get("StringWithMarkup", []):
-                    s = val.get("String", "")
-                    if s:
-                        results.append(s)
-        # Recurse into subsections
-        if "Section" in section:
-            results += extract_heading_info(section["Section"], target_heading)
-    return results
-
-# A function to find Uses and Use Classification sections
-def find_use_sections(root_sections):
-    uses_list, class_list = [], []
-    for section in root_sections:
-        if section.get("TOCHeading") == "Use and Manufacturing":
-            # Under that, look for "Uses" and "Use Classification"
-            subsec = section.get("Section", [])
-            uses_list += extract_heading_info(subsec, "Uses")
-            class_list += extract_heading_info(subsec, "Use Classification")
-        # Recurse to catch nested
-        if "Section" in section:
-            u, c = find_use_sections(section["Section"])
-            uses_list += u
-            class_list += c
-    return uses_list, class_list
-
 # A function to get Uses and Use Classification
-def get_pubchem_uses(cid):
-    uses, classifications = [], []
-    try:
-        url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug_view/data/compound/{cid}/JSON"
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        data = r.json()
-        root = data.get("Record", {}).get("Section", [])
-        uses, classifications = find_use_sections(root)
-    except Exception as e:
-        print(f"Error retrieving uses/classification for CID {cid}: {e}")
-    return "; ".join(uses), "; ".join(classifications)
-
-# A function to find DTXSID section
-def extract_heading_dtxsid(sections, target_heading):
-    results = []
-    for section in sections:
-        heading = section.get("TOCHeading", "")
-        if heading == target_heading:
-            for info in section.get("Information", []):
-                val_obj = info.get("Value", {})
-                if isinstance(val_obj, dict):
-                    string_markup = val_obj.get("StringWithMarkup", [])
-                    for val in string_markup:
-                        string = val.get("String", "")
-                        if string:
-                            results.append(string)
-        if "Section" in section:
-            results += extract_heading_dtxsid(section["Section"], target_heading)
-    return results
+def get_pubchem_uses(cid, full_record=False):
+    cached = cache_get('uses', cid)
+    if cached is not _MISS:
+        return tuple(cached)
+    values = get_pugview_values(cid, None if full_record else 'Use and Manufacturing')
+    if values is None:
+        return "", ""
+    result = "; ".join(values['Uses']), "; ".join(values['Use Classification'])
+    cache_set('uses', cid, result)
+    return result
 
 # A helper function to get DTXSID
-def get_dtxsid(cid):
+def get_dtxsid(cid, full_record=False):
     if cid is None:
         return None
-    try:
-        url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug_view/data/compound/{cid}/JSON"
-        res = requests.get(url, timeout=10)
-        res.raise_for_status()
-        data = res.json()
-        root_sections = data.get("Record", {}).get("Section", [])
-
-        # Extract DSSTox Substance ID from its actual heading
-        dtxsid_list = extract_heading_dtxsid(root_sections, "DSSTox Substance ID")
-        for sid in dtxsid_list:
-            if sid.startswith("DTXSID"):
-                return sid
-        return None
-    except Exception:
+    dtxsid = cache_get('dtxsid', cid)
+    if dtxsid is not _MISS:
+        return dtxsid
+    values = get_pugview_values(cid, None if full_record else 'DSSTox Substance ID')
+    if values is None:
         return None
 
+    # Extract DSSTox Substance ID from its actual heading
+    dtxsid = None
+    for sid in values['DSSTox Substance ID']:
+        if sid.startswith("DTXSID"):
+            dtxsid = sid
+            break
+    cache_set('dtxsid', cid, dtxsid)
+    return dtxsid
+
 # A function to get DTXSID
-def get_pubchem_dtxsid(identifier, input_type='name'):
+def get_pubchem_dtxsid(identifier, input_type='name', cid=None, full_record=False):
+    if cid is None:
+        cid = get_pubchem_cid(identifier, input_type)
+    return get_dtxsid(cid, full_record=full_record)
+
+# A function to retrieve all selected PubChem data for one identifier
+def retrieve_compound(identifier, input_type='name', options=None):
+    """
+    Resolve the identifier to a CID once and fetch InChIKey, CAS, SMILES, Uses,
+    Use Classification and DTXSID from it, as selected by the RetrievalOptions.
+    """
+    options = options or RetrievalOptions()
+    full_record = use_full_record(options)
+    inchikey = cas = smiles = uses = use_class = dtxsid = None
     cid = get_pubchem_cid(identifier, input_type)
-    return get_dtxsid(cid)
+    if cid is None:
+        return inchikey, cas, smiles, uses, use_class, dtxsid
+
+    inchikey, cas, smiles = get_pubchem_info(identifier, input_type=input_type,
+                                            retrieve_inchikey=options.inchikey,
+                                            retrieve_cas=options.cas,
+                                            retrieve_smiles=options.smiles,
+                                            cid=cid, full_record=full_record)
+    if options.uses:
+        uses, use_class = get_pubchem_uses(cid, full_record=full_record)
+    if options.dtxsid:
+        dtxsid = get_pubchem_dtxsid(identifier, input_type=input_type, cid=cid, full_record=full_record)
+    return inchikey, cas, smiles, uses, use_class, dtxsid
+
+# A checkpoint of finished lookups
+class Checkpoint:
+    """
+    Append-only JSONL file of finished lookups, one {"input_type", "identifier", "result"} object per line,
+    written and flushed as each lookup completes. A resumed run loads it and skips the lookups it already holds;
+    only those are kept in memory, new lookups are only written to the file.
+    The first line records the PubChem options the lookups were made with; a checkpoint written with other
+    options is discarded on resume, since its results lack the newly selected fields.
+    """
+    # Options that decide which fields a lookup result holds
+    OPTION_FIELDS = ('inchikey', 'cas', 'smiles', 'dtxsid', 'uses')
+
+    def __init__(self, path, resume=False, options=None):
+        self.path = path
+        self.results = {}
+        options = options or RetrievalOptions()
+        self.options = {field: getattr(options, field) for field in self.OPTION_FIELDS}
+        if resume and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                header, results = None, {}
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    if 'options' in entry:
+                        header = entry['options']
+                    else:
+                        results[(entry['input_type'], entry['identifier'])] = tuple(entry['result'])
+            if header == self.options:
+                self.results = results
+            else:
+                print(f"Checkpoint {path} was written with other options; starting over.\n" + "!"*150)
+                resume = False
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if not resume:
+            self.file.write(json.dumps({'options': self.options}) + "\n")
+            self.file.flush()
+        self.lock = threading.Lock()
+
+    def get(self, input_type, identifier):
+        return self.results.get((input_type, identifier))
+
+    def add(self, input_type, identifier, result):
+        line = json.dumps({'input_type': input_type, 'identifier': identifier, 'result': list(result)})
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self, remove=False):
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+# A function to normalize identifiers, so that repeated values are looked up once
+def normalize_identifier(identifier, input_type='name'):
+    if input_type == 'inchikey':
+        return identifier.strip().upper()
+    return identifier.strip().casefold()
+
+# A function to normalize a whole column of identifiers at once, as normalize_identifier does for one
+def normalize_identifiers(series, input_type='name'):
+    series = series.str.strip()
+    return series.str.upper() if input_type == 'inchikey' else series.str.casefold()
+
+# A function to pick the dtype of text columns: Arrow-backed strings when pyarrow is installed
+def text_dtype():
+    try:
+        import pyarrow
+    except ImportError:
+        return 'string'
+    return 'string[pyarrow]'
+
+# A function to read a column as text
+def text_values(series):
+    """
+    Return series as a text column, with every value that is not a string, e.g. a number or a missing cell, as NA.
+    """
+    if not pd.api.types.is_string_dtype(series.dtype):
+        return pd.Series(pd.NA, index=series.index, dtype=text_dtype())
+    # Object columns may hold no strings at all, e.g. only numbers, which the .str accessor rejects
+    if pd.api.types.infer_dtype(series, skipna=True) != 'string':
+        series = series.where(series.map(lambda v: isinstance(v, str)).astype(bool))
+    return series.astype(text_dtype())
+
+# A marker that stops the workers of a pipeline stage
+_STOP = object()
+
+# A stage of the retrieval pipeline
+class PipelineStage:
+    """
+    Worker threads applying func to the items put on a bounded queue; func may put its results on the next stage.
+    put() blocks while the queue is full, so a fast stage never runs far ahead of a slow one.
+    The first error raised by func is re-raised by join(); the workers keep draining the queue, so upstream never blocks.
+    If given, flush is called by join() once the workers have stopped, e.g. to pass on a partly filled batch.
+    After cancel(), e.g. on Ctrl+C, the workers skip the items still queued instead of sending their requests.
+    """
+    def __init__(self, func, workers, queue_size=None, flush=None):
+        self.func = func
+        self.flush = flush
+        self.queue = queue.Queue(maxsize=queue_size or PIPELINE_QUEUE_SIZE)
+        self.error = None
+        self.cancelled = False
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            if self.error is None and not self.cancelled:
+                try:
+                    self.func(item)
+                except BaseException as e:
+                    self.error = e
+
+    def join(self):
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.flush is not None and not self.cancelled:
+            self.flush()
+
+# A function to look up unique identifiers concurrently
+def resolve_identifiers(identifiers, input_type='name', options=None, checkpoint=None):
+    """
+    Look up a dict of {normalized identifier: identifier} and return {normalized identifier: result}, where a result
+    is the (InChIKey, CAS, SMILES, Uses, Use Classification, DTXSID) tuple of retrieve_compound.
+    The lookups run as a pipeline: chunks of BATCH_SIZE identifiers are resolved with batched requests where PubChem
+    allows it; names that need a request of their own are resolved by MAX_WORKERS threads and have their properties
+    fetched in batches of BATCH_SIZE. Each identifier then goes on to MAX_WORKERS lookup threads, and, if ClassyFire
+    is selected, each InChIKey found goes on to CLASSYFIRE_WORKERS threads while the remaining identifiers are still
+    being looked up.
+    Lookups already in the checkpoint are reused; new ones are added to it as they finish.
+    """
+    options = options or RetrievalOptions()
+    results, pending = {}, []
+    for key, identifier in identifiers.items():
+        result = checkpoint.get(input_type, key) if checkpoint is not None else None
+        if result is not None:
+            results[key] = result
+        else:
+            pending.append((key, identifier))
+
+    label = 'InChIKeys' if input_type == 'inchikey' else 'names'
+    progress = {'done': 0}
+    progress_lock = threading.Lock()
+    unresolved, batch = set(), []
+
+    def resolve(item):
+        key, identifier = item
+        failures = thread_failures()
+        get_pubchem_cid(identifier, input_type)
+        if thread_failures() != failures:
+            # A name whose CID request failed is not requested again by its lookup
+            unresolved.add(key)
+            _cid_store.setdefault((input_type, identifier), None)
+        properties.put(item)
+
+    def collect(item):
+        batch.append(item)
+        if len(batch) >= BATCH_SIZE:
+            flush_batch()
+
+    def flush_batch():
+        # Fetch the properties of a batch of resolved names with one request, then pass the names on
+        if batch:
+            prefetch_pubchem_properties([_cid_store.get((input_type, identifier)) for _, identifier in batch])
+            for item in batch:
+                lookups.put(item)
+            batch.clear()
+
+    def lookup(item):
+        key, identifier = item
+        failures = thread_failures()
+        result = retrieve_compound(identifier, input_type=input_type, options=options)
+        # Lookups that lost data to failed requests, including their CID request, are not checkpointed,
+        # so a resumed run retries them
+        if checkpoint is not None and thread_failures() == failures and key not in unresolved:
+            checkpoint.add(input_type, key, result)
+        results[key] = result
+        if classyfire is not None and result[0]:
+            classyfire.put(result[0])
+        with progress_lock:
+            progress['done'] += 1
+            done = progress['done']
+        if done % BATCH_SIZE == 0 or done == len(pending):
+            print(f"Looked up {done} of {len(pending)} unique {label}")
+
+    # Classifications fetched here are kept in the ClassyFire store for retrieve_classyfire_classification
+    classyfire = PipelineStage(get_classyfire_classification, CLASSYFIRE_WORKERS) if options.classyfire and options.inchikey else None
+    lookups = PipelineStage(lookup, MAX_WORKERS)
+    fetch_properties = options.inchikey or options.smiles
+    # Names missing from the stores are resolved concurrently, so that their properties can still be fetched in batches
+    batch_names = BATCH_MODE and input_type == 'name' and fetch_properties
+    properties = PipelineStage(collect, 1, flush=flush_batch) if batch_names else None
+    cids = PipelineStage(resolve, MAX_WORKERS) if batch_names else None
+    stages = [stage for stage in (cids, properties, lookups, classyfire) if stage is not None]
+    try:
+        if classyfire is not None:
+            for result in list(results.values()):
+                if result[0]:
+                    classyfire.put(result[0])
+        for start in range(0, len(pending), BATCH_SIZE):
+            chunk = pending[start:start + BATCH_SIZE]
+            # Resolve the chunk's identifiers with batched requests
+            if BATCH_MODE:
+                prefetch_pubchem_batch([identifier for _, identifier in chunk], input_type=input_type,
+                                       fetch_properties=fetch_properties)
+            for item in chunk:
+                if cids is not None and (input_type, item[1]) not in _cid_store:
+                    cids.put(item)
+                else:
+                    lookups.put(item)
+    except BaseException:
+        # On an error or Ctrl+C, the lookups still queued are dropped rather than sent
+        for stage in stages:
+            stage.cancel()
+        raise
+    finally:
+        # Each stage is joined after the stage feeding it, even if that one failed; the first error is re-raised
+        error = None
+        for stage in stages:
+            try:
+                stage.join()
+            except BaseException as e:
+                error = error or e
+        if error is not None:
+            raise error
+    return results
+
+# Columns of the ClassyFire classification table
+CLASSYFIRE_COLUMNS = ['InChIKey_ClassyFire', 'Status', 'Kingdom', 'Superclass', 'Class_ClassyFire', 'Subclass',
+                      'Parent Level 1', 'Parent Level 2', 'Parent Level 3', 'Parent Level 4', 'Parent Level 5']
+
+# A store of ClassyFire classifications, keyed by InChIKey, for one retrieve call
+_classyfire_store = {}
+
+# A function to empty the in-memory stores once a retrieve call is done
+def clear_stores():
+    """
+    Forget the CIDs, properties, PUG-View values and ClassyFire classifications held in memory, so that memory
+    does not grow across chunks or calls, and a long-lived process goes back to the cache (and its TTL) instead of
+    serving stale values. Called at the end of retrieve, retrieve_files, retrieve_shard and merge_shards.
+    """
+    _cid_store.clear()
+    _property_store.clear()
+    _cid_misses.clear()
+    _property_misses.clear()
+    _classyfire_store.clear()
+    with _pugview_lock:
+        _pugview_store.clear()
+
+# A function to get the ClassyFire classification of one InChIKey
+def get_classyfire_classification(inchikey):
+    """
+    Retrieve the ClassyFire classification of an InChIKey as a list of CLASSYFIRE_COLUMNS values.
+    Parent levels are the intermediate nodes of the classification followed by its direct parent.
+    Classifications, including InChIKeys that are not classified, are kept in the store and in the
+    local cache; classified InChIKeys are never looked up again, unclassified ones once the cache entry expires.
+    Returns None if the lookup failed.
+    """
+    key = inchikey.strip()
+    if key in _classyfire_store:
+        return _classyfire_store[key]
+    cached = cache_get('classyfire', key)
+    if cached is None:
+        # Not classified when it was last looked up, within the cache TTL
+        row = [key, 'Not classified'] + [None] * (len(CLASSYFIRE_COLUMNS) - 2)
+        _classyfire_store[key] = row
+        return row
+    # Unclassified rows cached by earlier versions never expire, so those InChIKeys are looked up again
+    if cached is not _MISS and cached[1] != 'Not classified':
+        _classyfire_store[key] = cached
+        return cached
+    try:
+        res = classyfire_get(CLASSYFIRE_URL.format(inchikey=key))
+        entity = res.json() if res.status_code == 200 else {}
+        if res.status_code not in (200, 404):
+            res.raise_for_status()
+    except Exception as e:
+        print(f"Error retrieving ClassyFire classification for '{key}': {e}")
+        return None
+
+    def name(node):
+        return node.get('name') if isinstance(node, dict) else None
+
+    if not entity or not name(entity.get('kingdom')):
+        row = [key, 'Not classified'] + [None] * (len(CLASSYFIRE_COLUMNS) - 2)
+    else:
+        parents = [name(node) for node in entity.get('intermediate_nodes') or []] + [name(entity.get('direct_parent'))]
+        parents = [p for p in parents if p][:5]
+        row = [key, 'Done', name(entity.get('kingdom')), name(entity.get('superclass')), name(entity.get('class')),
+               name(entity.get('subclass'))] + parents + [None] * (5 - len(parents))
+    _classyfire_store[key] = row
+    # Only real classifications are kept permanently; unclassified InChIKeys are cached as None and expire
+    cache_set('classyfire', key, row if row[1] == 'Done' else None)
+    return row
 
 # A function to get chemical class data from ClassyFire Batch
 def retrieve_classyfire_classification(df):
@@ -214,67 +1331,26 @@ def retrieve_classyfire_classification(df):
         print("No InChIKey column found. Skipping ClassyFire retrieval.\n" + "!"*150)
         return df
 
-    # Re-sorting table by 'InChIKey' column in descending fashion, N/As are moved to the bottom of the table
-    # This step is needed for further classificetion script to skip N/As
-    df = df.sort_values(by = inchikey_col, ascending = False, na_position = 'last')
-    df = df.reset_index(drop = True)
-    #QC printing
-    print('Sorted df by InChIKey:\n', df)
-    print(150*'-')
-
-    # Create a list of InChIKeys
-    inchikeys = df['InChIKey']
+    # Create a list of unique InChIKeys, skipping N/As
+    inchikeys = list(dict.fromkeys(key for key in df[inchikey_col].dropna() if isinstance(key, str) and key.strip()))
 
     print(f"ClassyFire classification started for {len(inchikeys)} InChIKeys...")
 
-    # Launch browser
-    driver = webdriver.Chrome()
-    driver.get("https://cfb.fiehnlab.ucdavis.edu/")
+    # Look up the InChIKeys concurrently
+    with ThreadPoolExecutor(max_workers=CLASSYFIRE_WORKERS) as executor:
+        rows = list(executor.map(get_classyfire_classification, inchikeys))
+    print("-" * 150)
 
-    try:
-        # Wait for the search text area and the ClassyFy button; the time can be adjusted based on page loading time
-        search_textarea = WebDriverWait(driver, 20).until(EC.presence_of_element_located((By.ID, 'inchikeys')))
-        classify_button = WebDriverWait(driver, 20).until(EC.element_to_be_clickable((By.CSS_SELECTOR, "input[type='submit']")))
-        
-        # Insert InChIKeys from the list
-        search_textarea.clear() #clearing the input field
-        # for key in df['InChIKey'].dropna().tolist(): #.dropna().tolist() is used to skip N/As, otherwise, the script crashes
-        for key in inchikeys.dropna().tolist(): #.dropna().tolist() is used to skip N/As, otherwise, the script crashes    
-            search_textarea.send_keys(key + "\n")
-
-        # Click the ClassyFy button after enter all InChIKeys
-        classify_button.click()
-
-        # Wait for the results to load; the time can be adjusted based on page loading time,
-        # 22000 sec are used to be sure the processing will be done before the script exits the webpage
-        WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.ID, 'results')))
-        table = WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.CLASS_NAME, 'table')))
-        reset_button = WebDriverWait(driver, 22000).until(EC.element_to_be_clickable((By.CLASS_NAME, 'btn-warning')))
-        
-        # Extract data from the result table
-        table_rows = table.find_elements(By.TAG_NAME, "tr") # Find all rows
-        data = [] # Create an empty array to store the data
-        for row in table_rows:
-            cols = row.find_elements(By.TAG_NAME, "td")
-            cols = [col.text for col in cols]
-            data.append(cols)
-        print("-" * 150)
-
-        # Create a list of column names; max. 11 columns are returned by ClassyFire
-        column_names = ['InChIKey_ClassyFire', 'Status', 'Kingdom', 'Superclass', 'Class_ClassyFire', 'Subclass', 'Parent Level 1', 'Parent Level 2', 'Parent Level 3', 'Parent Level 4', 'Parent Level 5']
-        # Adjust data to align with the specified column names
-        filled_data = [row + [None] * (len(column_names) - len(row)) for row in data]
-        # Convert data to df & add specified column names
-        df_classyfy = pd.DataFrame(filled_data, columns = column_names)
-        # Drop rows where all values are None, 'Status' and 'Kingdom' columns, and reset indices
-        df_classyfy.dropna(how = 'all', inplace = True)
-        
-        #QC printing
-        print('ClassiFyed table:\n', df_classyfy)
-        print("-" * 150)
+    # Key the classifications by the InChIKeys as they appear in the table, so that they can be merged
+    data = [[key] + row[1:] for key, row in zip(inchikeys, rows) if row is not None]
+    df_classyfy = pd.DataFrame(data, columns=CLASSYFIRE_COLUMNS)
+    failed = len(inchikeys) - len(data)
+    if failed:
+        print(f"ClassyFire lookup failed for {failed} InChIKeys.\n" + "!"*150)
 
-    finally:
-        driver.quit()
+    #QC printing
+    print('ClassiFyed table:\n', df_classyfy)
+    print("-" * 150)
 
     df = df.merge(df_classyfy, how='left', left_on=inchikey_col, right_on='InChIKey_ClassyFire')
     print("ClassyFire chemical classification added.\n" + "-"*150)
@@ -282,145 +1358,124 @@ def retrieve_classyfire_classification(df):
     df.reset_index(drop = True, inplace = True)
     return df
 
-# Main function
-def main():
-    print("-"*150)
-    start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print("Processing start time: ", start_time)
-    print("-"*150)
-
-    try:
-        root = Tk()
-        root.withdraw()
-        root.update()
-        file_path = filedialog.askopenfilename(
-            filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv"), ("Text files", "*.txt")]
-        )
-        root.destroy()
-    except Exception as e:
-        print(f"File dialog failed ({e}). Please enter file path manually:")
-        file_path = input("Path to input file: ").strip()
+# Fields of a lookup result, in the order of the retrieve_compound tuple, with the option and output column of each
+RESULT_FIELDS = [
+    ('inchikey', 'InChIKey_PubChem'), ('cas', 'CAS_PubChem'), ('smiles', 'SMILES_PubChem'),
+    ('uses', 'Uses'), ('uses', 'Use Classification'), ('dtxsid', 'DTXSID_PubChem'),
+]
 
-    if not file_path or not os.path.exists(file_path):
-        print("No valid file selected or path does not exist.\n" + "!" * 150)
-        return
+# Tables up to this many rows get a line per row in the console; larger ones only get a summary
+ROW_REPORT_LIMIT = 10000
 
-    ext = os.path.splitext(file_path)[1].lower()
-    if ext == '.xlsx':
-        df = pd.read_excel(file_path, engine='openpyxl')
-    elif ext in ['.csv', '.txt']:
-        df = pd.read_csv(file_path, sep=None, engine='python')
-    else:
-        print("Unsupported file format.\n" + "!"*150)
-        return
+# A function to turn lookup results into columns
+def results_frame(results, keys):
+    """
+    Return the results {normalized identifier: retrieve_compound tuple} of the given keys, one row per key
+    (NA for keys without a result), as a table with one text column per RESULT_FIELDS output column.
+    """
+    columns = [column for _, column in RESULT_FIELDS]
+    frame = pd.DataFrame.from_dict(results, orient='index', columns=columns)
+    frame = frame.reindex(pd.Index(keys.to_numpy(dtype=object, na_value=None)))
+    return frame.set_axis(keys.index).astype(text_dtype())
 
+# A function to retrieve PubChem data for every row of a table
+def retrieve_pubchem(df, options, checkpoint=None):
+    """
+    Look up each row of df in PubChem by options.input_column, falling back to the other identifier column
+    when nothing is found, and add the selected PubChem columns to df in place.
+    Rows are selected and results assembled column-wise; each unique identifier is looked up once.
+    Raises ValueError if the table has no usable input column.
+    """
     has_name = 'Name' in df.columns
     has_inchikey = 'InChIKey' in df.columns
 
     if not has_name and not has_inchikey:
-        print("Neither 'Name' nor 'InChIKey' column found. Exiting.\n" + "!"*150)
-        return
-
-    # Decide input mode
-    if has_name and has_inchikey:
-        print("Choose input column for compound search:")
-        print("1 = Name")
-        print("2 = InChIKey")
-        while True:
-            choice = input("Type 1 or 2 and press Enter: ").strip()
-            if choice in ['1', '2']:
-                input_mode = 'name' if choice == '1' else 'inchikey'
-                break
-            else:
-                print("Invalid input. Please enter 1 or 2.")
-        print("-" * 150)
-    else:
-        input_mode = 'name' if has_name else 'inchikey'
-
-    # Prepare output columns
-    inchikeys, cass, smiles_list = [], [], []
-    uses_list, use_class_list = [], []
-    dtxsids = []
+        raise ValueError("Neither 'Name' nor 'InChIKey' column found.")
+    # PubChem requests are reported for this call only
+    requests_before = METRICS.totals(exclude=('classyfire',))
+    input_mode = options.input_column or ('name' if has_name else 'inchikey')
+    if input_mode not in ('name', 'inchikey') or not (has_name if input_mode == 'name' else has_inchikey):
+        raise ValueError(f"Input column '{input_mode}' not found.")
 
     # Input series
     primary_series = df['Name'] if input_mode == 'name' else df['InChIKey']
     fallback_series = df['InChIKey'] if input_mode == 'name' and has_inchikey else df['Name'] if input_mode == 'inchikey' and has_name else None
     fallback_mode = 'inchikey' if input_mode == 'name' else 'name'
 
-    for idx, (i, primary_val) in enumerate(primary_series.items(), start=1):
-        inchikey = cas = smiles = uses = use_class = dtxsid = None
-        # Skip if it's an unknown feature based on Name column
-        if 'Name' in df.columns and isinstance(df.at[i, 'Name'], str) and 'Feature' in df.at[i, 'Name']:
+    # Skip unknown features based on Name column, and rows without a text identifier
+    primary_text = text_values(primary_series)
+    is_feature = text_values(df['Name']).str.contains('Feature', regex=False).fillna(False).astype(bool) if has_name \
+        else pd.Series(False, index=df.index)
+    is_invalid = primary_text.isna() & ~is_feature
+
+    # Group rows by normalized identifier, so that each unique value is looked up once
+    primary_keys = normalize_identifiers(primary_text, input_mode).mask(is_feature)
+    first = primary_keys.notna() & ~primary_keys.duplicated()
+    unique_primaries = dict(zip(primary_keys[first], primary_text[first].str.strip()))
+
+    print(f"{len(unique_primaries)} unique identifiers to look up for {len(df)} rows.")
+    print("-"*150)
+    primary_results = resolve_identifiers(unique_primaries, input_type=input_mode, options=options, checkpoint=checkpoint)
+    values = results_frame(primary_results, primary_keys)
+
+    # If nothing was retrieved and fallback is available, look up each unique fallback identifier once
+    found = (values.notna() & values.ne('')).any(axis=1).astype(bool)
+    fallback_text = text_values(fallback_series) if fallback_series is not None else pd.Series(pd.NA, index=df.index, dtype=text_dtype())
+    use_fallback = ~found & fallback_text.notna()
+    fallback_keys = normalize_identifiers(fallback_text, fallback_mode).where(use_fallback)
+    first = use_fallback & ~fallback_keys.duplicated()
+    unique_fallbacks = dict(zip(fallback_keys[first], fallback_text[first].str.strip()))
+    if fallback_series is not None:
+        fallback_results = resolve_identifiers(unique_fallbacks, input_type=fallback_mode, options=options, checkpoint=checkpoint)
+        values[use_fallback] = results_frame(fallback_results, fallback_keys[use_fallback])
+    print("-"*150)
+
+    # Report the rows
+    if len(df) <= ROW_REPORT_LIMIT:
+        report_rows(primary_series, values, is_feature, is_invalid, use_fallback, fallback_text, options)
+    print(f"{int(found.sum())} rows found by {input_mode}, {int(use_fallback.sum())} looked up by {fallback_mode}, "
+          f"{int(is_feature.sum())} unknown features and {int(is_invalid.sum())} invalid inputs skipped.")
+    request_stats = {key: value - requests_before[key] for key, value in METRICS.totals(exclude=('classyfire',)).items()}
+    print(f"PubChem requests: {request_stats['requests']}, retried: {request_stats['retried']}, "
+          f"failed after {MAX_RETRIES} retries: {request_stats['failed']}")
+    if request_stats['failed']:
+        print("Some lookups failed permanently; their rows may be incomplete and can be retried in a later run.\n" + "!"*150)
+    else:
+        print("-"*150)
+
+    # Add results to DataFrame
+    for option, column in RESULT_FIELDS:
+        if getattr(options, option):
+            df[column] = values[column]
+    return df
+
+# A function to print the lookup result of every row
+def report_rows(primary_series, values, is_feature, is_invalid, use_fallback, fallback_text, options):
+    rows = zip(primary_series, is_feature, is_invalid, use_fallback, fallback_text, values.itertuples(index=False, name=None))
+    for idx, (primary_val, feature, invalid, fallback, fallback_val, row) in enumerate(rows, start=1):
+        if feature:
             print(f"{idx}: {primary_val}  -->  Skipped (unknown feature)")
-        elif pd.isna(primary_val) or not isinstance(primary_val, str):
+        elif invalid:
             print(f"{idx}: {primary_val}  -->  Skipped (invalid primary input)")
-        else:
-            inchikey, cas, smiles = get_pubchem_info(primary_val, input_type=input_mode,
-                                                    retrieve_inchikey=RETRIEVE_INCHIKEY,
-                                                    retrieve_cas=RETRIEVE_CAS,
-                                                    retrieve_smiles=RETRIEVE_SMILES)
-            if RETRIEVE_USES:
-                cid = get_pubchem_cid(primary_val, input_type=input_mode)
-                if cid:
-                    uses, use_class = get_pubchem_uses(cid)
-            if RETRIEVE_DTXSID:
-                dtxsid = get_pubchem_dtxsid(primary_val, input_type=input_mode)
-
-        # If nothing was retrieved and fallback is available
-        if fallback_series is not None and (not any([inchikey, cas, smiles, uses, use_class, dtxsid])):
-            try:
-                fallback_val = fallback_series.loc[i]
-            except KeyError:
-                fallback_val = None
-
-            if pd.notna(fallback_val) and isinstance(fallback_val, str):
-                print(f"Name for ID {idx} not found in PubChem. Using InChIKey instead: {fallback_val}")
-                inchikey, cas, smiles = get_pubchem_info(fallback_val, input_type=fallback_mode,
-                                                        retrieve_inchikey=RETRIEVE_INCHIKEY,
-                                                        retrieve_cas=RETRIEVE_CAS,
-                                                        retrieve_smiles=RETRIEVE_SMILES)
-                if RETRIEVE_USES:
-                    cid = get_pubchem_cid(fallback_val, input_type=fallback_mode)
-                    if cid:
-                        uses, use_class = get_pubchem_uses(cid)
-                if RETRIEVE_DTXSID:
-                    dtxsid = get_pubchem_dtxsid(fallback_val, input_type=fallback_mode)
-
-        # Append results
-        inchikeys.append(inchikey)
-        cass.append(cas)
-        smiles_list.append(smiles)
-        uses_list.append(uses if RETRIEVE_USES else None)
-        use_class_list.append(use_class if RETRIEVE_USES else None)
-        dtxsids.append(dtxsid if RETRIEVE_DTXSID else None)
+        if fallback:
+            print(f"Name for ID {idx} not found in PubChem. Using InChIKey instead: {fallback_val.strip()}")
+        inchikey, cas, smiles, uses, use_class, dtxsid = (None if pd.isna(v) else v for v in row)
 
         result = [f"{idx}: {primary_val}"]
-        if RETRIEVE_INCHIKEY: result.append(f"InChIKey: {inchikey or 'None'}")
-        if RETRIEVE_CAS: result.append(f"CAS#: {cas or 'None'}")
-        if RETRIEVE_SMILES: result.append(f"SMILES: {smiles or 'None'}")
-        if RETRIEVE_USES:
+        if options.inchikey: result.append(f"InChIKey: {inchikey or 'None'}")
+        if options.cas: result.append(f"CAS#: {cas or 'None'}")
+        if options.smiles: result.append(f"SMILES: {smiles or 'None'}")
+        if options.uses:
             result.append(f"Uses: {'Found' if uses else 'None'}")
             result.append(f"Use Classification: {'Found' if use_class else 'None'}")
-        if RETRIEVE_DTXSID:
+        if options.dtxsid:
             result.append(f"DTXSID: {dtxsid or 'None'}")
 
         print("; ".join(result))
         print("-" * 200)
-        time.sleep(0.1)
-
-    # Add results to DataFrame
-    if RETRIEVE_INCHIKEY:
-        df['InChIKey_PubChem'] = inchikeys
-    if RETRIEVE_CAS:
-        df['CAS_PubChem'] = cass
-    if RETRIEVE_SMILES:
-        df['SMILES_PubChem'] = smiles_list
-    if RETRIEVE_USES:
-        df['Uses'] = uses_list
-        df['Use Classification'] = use_class_list
-    if RETRIEVE_DTXSID:
-        df['DTXSID_PubChem'] = dtxsids
 
+# A function to add the consensus InChIKey column
+def add_consensus_inchikey(df):
     # Consensus InChIKey generation
     has_inchikey = 'InChIKey' in df.columns
     has_inchikey_pubchem = 'InChIKey_PubChem' in df.columns
@@ -428,140 +1483,774 @@ def main():
     if not has_inchikey and not has_inchikey_pubchem:
         print("Neither 'InChIKey' nor 'InChIKey_PubChem' found. Skipping consensus InChIKey creation.")
         print("!"*150)
-    else:
-        # Determine insertion index
-        insert_after_col = 'InChIKey' if has_inchikey else 'InChIKey_PubChem'
-        insert_index = df.columns.get_loc(insert_after_col) + 1
-
-        # Insert empty column
-        df.insert(insert_index, 'InChIKey_Consensus', pd.NA)
-        print(f"'InChIKey_Consensus' column inserted after '{insert_after_col}'.")
-
-        # Fill from 'InChIKey_PubChem' first
-        if has_inchikey_pubchem:
-            df['InChIKey_Consensus'] = df['InChIKey_PubChem']
-            print("Values from 'InChIKey_PubChem' copied to 'InChIKey_Consensus'.")
-
-        # Fill NaNs with values from 'InChIKey'
-        if has_inchikey:
-            mask = df['InChIKey_Consensus'].isna()
-            df.loc[mask, 'InChIKey_Consensus'] = df.loc[mask, 'InChIKey']
-            print("NaN values in 'InChIKey_Consensus' filled using 'InChIKey'.")
-            print("-"*150)
-    
+        return df
+
+    # InChIKeys from PubChem first, with the gaps filled from the input InChIKeys
+    consensus = text_values(df['InChIKey_PubChem']) if has_inchikey_pubchem else text_values(df['InChIKey'])
+    if has_inchikey_pubchem and has_inchikey:
+        consensus = consensus.fillna(text_values(df['InChIKey']))
+    insert_after_col = 'InChIKey' if has_inchikey else 'InChIKey_PubChem'
+    df.insert(df.columns.get_loc(insert_after_col) + 1, 'InChIKey_Consensus', consensus)
+    print(f"'InChIKey_Consensus' column inserted after '{insert_after_col}'.")
+    if has_inchikey_pubchem:
+        print("Values from 'InChIKey_PubChem' copied to 'InChIKey_Consensus'.")
+    if has_inchikey:
+        print("NaN values in 'InChIKey_Consensus' filled using 'InChIKey'.")
+        print("-"*150)
+    return df
+
+# Retrieved PubChem and classification columns, in output order; all of them hold text
+OUTPUT_COLUMNS = [
+    'InChIKey_PubChem', 'CAS_PubChem', 'SMILES_PubChem', 'DTXSID_PubChem', 'Uses', 'Use Classification',
+    'Superclass', 'Class_ClassyFire', 'Subclass',
+    'Parent Level 1', 'Parent Level 2', 'Parent Level 3', 'Parent Level 4', 'Parent Level 5'
+]
+
+# A function to move the PubChem and classification columns to the end of the table
+def reorder_columns(df):
+    # Reorder classification and PubChem columns with a single selection
+    columns_to_move = [col for col in OUTPUT_COLUMNS if col in df.columns]
+    return df[[col for col in df.columns if col not in columns_to_move] + columns_to_move]
+
+# A function to retrieve all selected data for a table
+def retrieve(df, options=None, checkpoint=None):
+    """
+    Retrieve the data selected by options (a RetrievalOptions or a dict of its fields) for every row of df,
+    which needs a 'Name' and/or 'InChIKey' column, and return the table with the retrieved columns added.
+    This is the entry point for using the retriever as a library; it never prompts.
+    A Checkpoint may be given to record lookups as they finish and reuse those of an interrupted run.
+    """
+    if options is None:
+        options = RetrievalOptions()
+    elif isinstance(options, dict):
+        options = RetrievalOptions(**options)
+    df = df.copy()
+    try:
+        retrieve_pubchem(df, options, checkpoint=checkpoint)
+        return finalize(df, options)
+    finally:
+        clear_stores()
+
+# A function to add the table-level columns once all PubChem data is retrieved
+def finalize(df, options):
+    """
+    Add the consensus InChIKey and, if selected, the ClassyFire classification to a table that went through
+    retrieve_pubchem, and move the retrieved columns to the end.
+    """
+    df = add_consensus_inchikey(df)
+
     # Add ClassyFire classification if requested
-    if RETRIEVE_CLASSYFIRE:
+    if options.classyfire:
         df = retrieve_classyfire_classification(df)
 
-    # Reorder classification and PubChem columns
-    columns_to_move = [
-        'InChIKey_PubChem', 'CAS_PubChem', 'SMILES_PubChem', 'DTXSID_PubChem', 'Uses', 'Use Classification',
-        'Superclass', 'Class_ClassyFire', 'Subclass',
-        'Parent Level 1', 'Parent Level 2', 'Parent Level 3', 'Parent Level 4', 'Parent Level 5'
-    ]
-    
-    # Filter to include only columns that actually exist in the DataFrame
-    columns_to_move = [col for col in columns_to_move if col in df.columns]
-
-    # Pop all columns first to avoid index issues
-    popped_cols = {col: df.pop(col) for col in columns_to_move}
-
-    # Append them at the end
-    for col in columns_to_move:
-        df[col] = popped_cols[col]
-        
-    # Format output Excel file
-    def apply_excel_formatting(file_path):
-        wb = openpyxl.load_workbook(file_path)
-        ws = wb.active
-
-        # Find header row and build column index
-        header = [cell.value for cell in ws[1]]
-        col_idx = {col: idx + 1 for idx, col in enumerate(header)}
-        
-        # Prevent Excel from converting CAS# to date/time
-        if "CAS" in col_idx:
-            col_letter = openpyxl.utils.get_column_letter(col_idx["CAS"])
-            for row in range(2, ws.max_row + 1):
-                cell = ws[f"{col_letter}{row}"]
-                cell.number_format = "@"
-        if "CASRN" in col_idx:
-            col_letter = openpyxl.utils.get_column_letter(col_idx["CASRN"])
-            for row in range(2, ws.max_row + 1):
-                cell = ws[f"{col_letter}{row}"]
-                cell.number_format = "@"
-        if "CAS#" in col_idx:
-            col_letter = openpyxl.utils.get_column_letter(col_idx["CAS#"])
-            for row in range(2, ws.max_row + 1):
-                cell = ws[f"{col_letter}{row}"]
-                cell.number_format = "@"
-        if "CAS_PubChem" in col_idx:
-            col_letter = openpyxl.utils.get_column_letter(col_idx["CAS_PubChem"])
-            for row in range(2, ws.max_row + 1):
-                cell = ws[f"{col_letter}{row}"]
-                cell.number_format = "@"
-
-        # Headers alignment and row height
-        for cell in ws[1]:
-            cell.alignment = Alignment(horizontal="left", vertical="top", wrap_text=True)
-        ws.row_dimensions[1].height = 60
+    return reorder_columns(df)
 
-        # Freeze top row
-        ws.freeze_panes = "A2"
+# A function to retrieve all selected data for several tables at once
+def retrieve_files(tables, options=None, checkpoint=None):
+    """
+    Retrieve the data selected by options for a list of tables, e.g. the sample files of one batch, and return
+    the processed tables in the same order. The identifiers of all tables are pooled, so that an identifier
+    found in several tables is looked up only once; each table is then finalized on its own.
+    """
+    if options is None:
+        options = RetrievalOptions()
+    elif isinstance(options, dict):
+        options = RetrievalOptions(**options)
+    identifier_columns = ['Name', 'InChIKey']
+    combined = pd.concat([table[[c for c in identifier_columns if c in table.columns]] for table in tables],
+                         ignore_index=True)
+    try:
+        retrieve_pubchem(combined, options, checkpoint=checkpoint)
+        retrieved_columns = [c for c in combined.columns if c not in identifier_columns]
+
+        results, start = [], 0
+        for table in tables:
+            table = table.copy()
+            for column in retrieved_columns:
+                table[column] = combined[column].iloc[start:start + len(table)].set_axis(table.index)
+            start += len(table)
+            results.append(finalize(table, options))
+        return results
+    finally:
+        clear_stores()
+
+# Column holding each row's position in the input, so that shards can be merged back in the original order
+SHARD_ROW_COLUMN = '_row'
+
+# A function to select the rows of one shard
+def shard_mask(df, shards, shard, by='hash', input_column=None):
+    """
+    Return a boolean array selecting the rows of shard number shard (0 to shards - 1) of df.
+    'range' splits the table into contiguous blocks of rows; 'hash' assigns rows by a stable hash of their
+    normalized identifier, so that repeated identifiers are looked up by a single shard.
+    """
+    if by == 'range':
+        positions = pd.RangeIndex(len(df))
+        return (positions >= len(df) * shard // shards) & (positions < len(df) * (shard + 1) // shards)
+    input_mode = input_column or ('name' if 'Name' in df.columns else 'inchikey')
+    column = df['Name' if input_mode == 'name' else 'InChIKey']
+    buckets = column.map(lambda v: zlib.crc32(normalize_identifier(v, input_mode).encode()) % shards
+                         if isinstance(v, str) else 0)
+    return (buckets == shard).to_numpy()
+
+# A function to retrieve the PubChem data of one shard
+def retrieve_shard(df, options, shards, shard, by='hash', checkpoint=None):
+    """
+    Retrieve the PubChem data for the rows of one shard of df and return them with their input positions in
+    SHARD_ROW_COLUMN. Consensus InChIKeys and ClassyFire are left to merge_shards, which applies them once.
+    """
+    mask = shard_mask(df, shards, shard, by=by, input_column=options.input_column)
+    part = df[mask].copy()
+    part[SHARD_ROW_COLUMN] = pd.RangeIndex(len(df))[mask]
+    print(f"Shard {shard} of {shards} ({by}): {len(part)} of {len(df)} rows.")
+    print("-"*150)
+    try:
+        retrieve_pubchem(part, replace(options, classyfire=False), checkpoint=checkpoint)
+    finally:
+        clear_stores()
+    return part
+
+# A function to merge the intermediate files of all shards
+def merge_shards(paths, options):
+    """
+    Read the intermediate files written by retrieve_shard, restore the original row order,
+    and finalize the table once for all shards.
+    """
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise ValueError(f"Shard files not found: {', '.join(missing)}")
+    df = pd.concat([pd.read_pickle(path) for path in paths])
+    df = df.sort_values(SHARD_ROW_COLUMN, kind='stable').drop(columns=SHARD_ROW_COLUMN).reset_index(drop=True)
+    print(f"Merged {len(paths)} shards: {len(df)} rows.")
+    print("-"*150)
+    try:
+        return finalize(df, options)
+    finally:
+        clear_stores()
 
-        # Set zoom level to 80%
+# A function to detect the delimiter of a CSV or TXT file from its first lines
+def sniff_delimiter(file_path, sample_size=65536):
+    with open(file_path, newline='', encoding='utf-8', errors='replace') as f:
+        sample = f.read(sample_size)
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=',\t;|').delimiter
+    except csv.Error:
+        return '\t' if file_path.lower().endswith('.txt') else ','
+
+# A function to read the input table
+def read_input(file_path, sep=None):
+    """
+    Read an .xlsx, .csv or .txt table. The delimiter of text files is sniffed once from the start of the
+    file unless given, so that the fast C parser can be used.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.xlsx':
+        return pd.read_excel(file_path, engine='openpyxl')
+    elif ext in ['.csv', '.txt']:
+        return pd.read_csv(file_path, sep=sep or sniff_delimiter(file_path), engine='c')
+    raise ValueError(f"Unsupported file format: {ext}")
+
+# A function to read the input table in chunks
+def iter_input_chunks(file_path, chunksize, sep=None):
+    """
+    Yield the rows of an .xlsx, .csv or .txt table as DataFrames of up to chunksize rows, indexed by row
+    position in the file, without loading the whole table. Excel files are read with a read-only workbook.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext in ['.csv', '.txt']:
+        yield from pd.read_csv(file_path, sep=sep or sniff_delimiter(file_path), engine='c', chunksize=chunksize)
+        return
+    if ext != '.xlsx':
+        raise ValueError(f"Unsupported file format: {ext}")
+
+    import openpyxl
+    wb = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        start, buffer = 0, []
+        for row in rows:
+            # Read-only worksheets leave out empty cells at the end of a row
+            buffer.append(row + (None,) * (len(header) - len(row)))
+            if len(buffer) == chunksize:
+                yield pd.DataFrame(buffer, columns=header, index=range(start, start + len(buffer)))
+                start, buffer = start + len(buffer), []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=header, index=range(start, start + len(buffer)))
+    finally:
+        wb.close()
+
+# Writers appending processed chunks to the output file as they finish
+class CsvChunkWriter:
+    def __init__(self, path):
+        self.path = path
+        self.columns = None
+
+    def append(self, df):
+        if self.columns is None:
+            self.columns = list(df.columns)
+            df.to_csv(self.path, index=False)
+        else:
+            df.reindex(columns=self.columns).to_csv(self.path, mode='a', header=False, index=False)
+
+    def close(self):
+        pass
+
+class ParquetChunkWriter:
+    """
+    Appends chunks as row groups of one Parquet file. Needs pyarrow; the retrieved columns are written as
+    strings, so that chunks without any retrieved value keep the same schema.
+    """
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("Parquet output needs pyarrow (pip install pyarrow).")
+        self.pa, self.pq = pa, pq
+        self.path = path
+        self.writer = None
+
+    def append(self, df):
+        pa = self.pa
+        text_columns = [col for col in df.columns if col in OUTPUT_COLUMNS or col == 'InChIKey_Consensus']
+        df = df.astype({col: 'string' for col in text_columns})
+        if self.writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            schema = pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in table.schema])
+            self.writer = self.pq.ParquetWriter(self.path, schema)
+        table = pa.Table.from_pandas(df.reindex(columns=self.writer.schema.names), preserve_index=False)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+# Output Excel formatting: columns holding CAS numbers are stored as text, so that Excel does not convert them
+# to dates; other listed columns get a fixed width or a width fitted to their content
+CAS_COLUMNS = ["CAS", "CASRN", "CAS#", "CAS_PubChem"]
+FIXED_WIDTH_COLUMNS = {"Name": 52}
+AUTO_WIDTH_COLUMNS = ["Name", "Formula", "CAS#", "CAS", "CAS_PubChem", "CASRN", "Class_FUse", "Class_NORMAN", "Class", "DTXSID_PubChem", "DTXSID"]
+
+# A function to compute output column widths from the table
+def column_widths(df):
+    widths = {col: width for col, width in FIXED_WIDTH_COLUMNS.items() if col in df.columns}
+    # Auto-adjust selected columns (approximate by content length)
+    for col in AUTO_WIDTH_COLUMNS:
+        if col in df.columns:
+            values = df[col].dropna()
+            values = values[values.astype(object).astype(bool)].astype(str)
+            max_length = int(values.str.len().max()) if len(values) else 0
+            widths[col] = min(max_length + 2, 100)
+    return widths
+
+class ExcelChunkWriter:
+    """
+    Writes the formatted output workbook in one pass with a write-only openpyxl workbook, which keeps memory use flat.
+    Header style, frozen top row, zoom and column widths are set before the first row is written, so column
+    widths are computed from the first chunk; CAS columns are written as text cells. The workbook is saved on close.
+    """
+    def __init__(self, path):
+        import openpyxl
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Alignment, Border, Font, Side
+        from openpyxl.utils import get_column_letter
+        self.WriteOnlyCell, self.Alignment, self.get_column_letter = WriteOnlyCell, Alignment, get_column_letter
+        self.Border, self.Font, self.Side = Border, Font, Side
+        self.path = path
+        self.wb = openpyxl.Workbook(write_only=True)
+        self.ws = self.wb.create_sheet()
+        self.columns = None
+
+    def _write_header(self, df):
+        ws = self.ws
+        self.columns = list(df.columns)
+        col_idx = {col: idx + 1 for idx, col in enumerate(self.columns)}
+
+        # Set column widths
+        for col, width in column_widths(df).items():
+            ws.column_dimensions[self.get_column_letter(col_idx[col])].width = width
+
+        # Freeze top row and set zoom level to 80%
+        ws.freeze_panes = "A2"
         ws.sheet_view.zoomScale = 80
 
-        # Set column widths safely
-        for cols, width in [
-            (["Name"], 52),
-        ]:
-            for col in cols:
-                if col in col_idx:
-                    col_letter = openpyxl.utils.get_column_letter(col_idx[col])
-                    ws.column_dimensions[col_letter].width = width
-
-        # Auto-adjust selected columns (approximate by content length)
-        auto_cols = ["Name", "Formula", "CAS#", "CAS", "CAS_PubChem", "CASRN", "Class_FUse", "Class_NORMAN", "Class", "DTXSID_PubChem", "DTXSID"]
-        for col in auto_cols:
-            if col in col_idx:
-                col_letter = openpyxl.utils.get_column_letter(col_idx[col])
-                max_length = 0
-                for row in ws.iter_rows(min_row=2, min_col=col_idx[col], max_col=col_idx[col]):
-                    for cell in row:
-                        try:
-                            if cell.value:
-                                max_length = max(max_length, len(str(cell.value)))
-                        except:
-                            pass
-                adjusted_width = min(max_length + 2, 100)
-                ws.column_dimensions[col_letter].width = adjusted_width
-
-        # Save workbook
-        wb.save(file_path)
-        print(f"Formatting applied and saved to: {file_path}")
-        print(150 * "-")
-        
-    # Save results
-    if file_path:
-        print(f"Writing data to the output file...")
-        base, ext = os.path.splitext(file_path)
-        processed_path = f"{base}_PubChem.xlsx"
-        df.to_excel(processed_path, index=False, engine='openpyxl')
+        # Headers style of df.to_excel (bold, thin borders), alignment and row height
+        ws.row_dimensions[1].height = 60
+        thin = self.Side(style="thin")
+        header = []
+        for col in self.columns:
+            cell = self.WriteOnlyCell(ws, value=col)
+            cell.font = self.Font(bold=True)
+            cell.border = self.Border(left=thin, right=thin, top=thin, bottom=thin)
+            cell.alignment = self.Alignment(horizontal="left", vertical="top", wrap_text=True)
+            header.append(cell)
+        ws.append(header)
+        self.cas_positions = [col_idx[col] - 1 for col in CAS_COLUMNS if col in col_idx]
+
+    def append(self, df):
+        if self.columns is None:
+            self._write_header(df)
+        df = df.reindex(columns=self.columns).astype(object)
+        for row in df.where(df.notna(), None).itertuples(index=False, name=None):
+            if self.cas_positions:
+                row = list(row)
+                # Prevent Excel from converting CAS# to date/time
+                for pos in self.cas_positions:
+                    cell = self.WriteOnlyCell(self.ws, value=row[pos])
+                    cell.number_format = "@"
+                    row[pos] = cell
+            self.ws.append(row)
+
+    def close(self):
+        self.wb.save(self.path)
+
+# A function to open a chunk writer for the output file's format
+def open_output_writer(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        return CsvChunkWriter(path)
+    elif ext == '.parquet':
+        return ParquetChunkWriter(path)
+    elif ext == '.xlsx':
+        return ExcelChunkWriter(path)
+    raise ValueError(f"Unsupported output format: {ext}")
+
+# A function to write the output file
+def write_output(df, processed_path):
+    print(f"Writing data to the output file...")
+    # Excel output is written and formatted in a single pass
+    writer = open_output_writer(processed_path)
+    writer.append(df)
+    writer.close()
+    print(f"Processed data saved to: {processed_path}")
+    print("-"*150)
 
-        # Apply formatting
-        apply_excel_formatting(processed_path)
+# A function to choose the input file in a file dialog, or in the terminal if no display is available
+def choose_input_file():
+    try:
+        from tkinter import Tk, filedialog
+        root = Tk()
+        root.withdraw()
+        root.update()
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv"), ("Text files", "*.txt")]
+        )
+        root.destroy()
+    except Exception as e:
+        print(f"File dialog failed ({e}). Please enter file path manually:")
+        file_path = input("Path to input file: ").strip()
+    return file_path
 
-        print(f"Processed data saved to: {processed_path}")
+# A function to ask for the input column when the table has both
+def prompt_input_column():
+    print("Choose input column for compound search:")
+    print("1 = Name")
+    print("2 = InChIKey")
+    while True:
+        choice = input("Type 1 or 2 and press Enter: ").strip()
+        if choice in ['1', '2']:
+            print("-" * 150)
+            return 'name' if choice == '1' else 'inchikey'
+        print("Invalid input. Please enter 1 or 2.")
+
+# A function to parse command-line arguments
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Retrieve compound data from PubChem and ClassyFire Batch. "
+                    "Without any data options, the options are asked for interactively."
+    )
+    parser.add_argument('input', nargs='?',
+                        help="input .xlsx, .csv or .txt file, or a directory or quoted glob pattern of input files "
+                             "processed together; a file dialog opens if omitted")
+    parser.add_argument('-o', '--output', help="output .xlsx, .csv or .parquet file (default: <input>_PubChem.xlsx), "
+                                               "or output directory for a batch of input files")
+    parser.add_argument('--inchikey', action='store_true', help="retrieve InChIKeys from PubChem")
+    parser.add_argument('--cas', action='store_true', help="retrieve CAS# from PubChem")
+    parser.add_argument('--smiles', action='store_true', help="retrieve SMILES from PubChem")
+    parser.add_argument('--dtxsid', action='store_true', help="retrieve DSSTox SIDs from PubChem")
+    parser.add_argument('--uses', action='store_true', help="retrieve Uses & Use Classification from PubChem")
+    parser.add_argument('--classyfire', action='store_true', help="retrieve chemical class data from ClassyFire Batch")
+    parser.add_argument('--all', action='store_true', help="retrieve all of the above")
+    parser.add_argument('--input-column', choices=['name', 'inchikey'],
+                        help="column to search PubChem by (default: Name if present, otherwise InChIKey)")
+    parser.add_argument('--sep', help="delimiter of .csv/.txt input (default: detected from the first lines)")
+    parser.add_argument('--chunksize', type=int, metavar='N',
+                        help="stream the input in chunks of N rows, appending each processed chunk to the output")
+    parser.add_argument('--cache', metavar='PATH', help="use a local SQLite cache of PubChem results at PATH")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted run from its checkpoint file instead of starting over")
+    parser.add_argument('--shards', type=int, metavar='N',
+                        help="split the input into N shards; without --shard or --merge, each shard runs in its own process")
+    parser.add_argument('--shard', type=int, metavar='K',
+                        help="process only shard K (0 to N-1) into an intermediate file, e.g. on one node of a cluster")
+    parser.add_argument('--shard-by', choices=['hash', 'range'], default='hash',
+                        help="assign rows to shards by identifier hash (default) or by contiguous row ranges")
+    parser.add_argument('--merge', action='store_true',
+                        help="merge the intermediate files of all --shards into the output")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="save per-endpoint request counts, latencies, bytes, retries and cache hits as JSON at PATH")
+    parser.add_argument('--profile', metavar='PATH', help="profile the run, including worker threads, and save the stats at PATH")
+    parser.add_argument('--index', metavar='PATH',
+                        help="resolve CIDs, InChIKeys and SMILES from a local index built with --build-index first")
+    index_group = parser.add_argument_group("building a local index from PubChem bulk files")
+    index_group.add_argument('--build-index', metavar='PATH', help="build a local index at PATH and exit")
+    index_group.add_argument('--cid-inchikey', metavar='FILE', help="CID-InChI-Key(.gz) bulk file")
+    index_group.add_argument('--cid-smiles', metavar='FILE', help="CID-SMILES(.gz) bulk file")
+    index_group.add_argument('--cid-synonym', metavar='FILE', help="CID-Synonym-filtered(.gz) bulk file")
+    return parser.parse_args(argv)
+
+# A function to start profiling the main thread and every thread started afterwards
+def start_profiling():
+    import cProfile
+    profilers = []
+
+    def profile_thread(frame, event, arg):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # From Python 3.12, the main thread's profiler already covers all threads
+            sys.setprofile(None)
+            return
+        profilers.append(profiler)
+
+    threading.setprofile(profile_thread)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    profilers.append(profiler)
+    return profilers
+
+# A function to merge the profiles of all threads and save them
+def stop_profiling(profilers, path):
+    import pstats
+    threading.setprofile(None)
+    profilers[0].disable()
+    stats = pstats.Stats(profilers[0])
+    for profiler in profilers[1:]:
+        stats.add(profiler)
+    stats.dump_stats(path)
+    print(f"Profile saved to: {path} (view it with: python -m pstats {path})")
+    print("-"*150)
+
+# Main function
+def main(argv=None):
+    args = parse_args(argv)
+    METRICS.reset()
+    profilers = start_profiling() if args.profile else None
+    try:
+        return run(args)
+    finally:
+        if profilers:
+            stop_profiling(profilers, args.profile)
+        if args.metrics:
+            write_metrics(args.metrics)
+
+# Input file types picked up from a directory or glob pattern in batch mode
+INPUT_EXTENSIONS = ('.xlsx', '.csv', '.txt')
+
+# A function to tell a batch of input files, given as a directory or a glob pattern, from a single file
+def is_batch_input(path):
+    return os.path.isdir(path) or any(c in path for c in '*?[')
+
+# A function to list the input files of a batch
+def find_input_files(pattern):
+    """
+    List the .xlsx, .csv and .txt files in a directory or matching a glob pattern, in name order.
+    Outputs of earlier runs (*_PubChem.*) and Excel lock files (~$*) are left out.
+    """
+    paths = [os.path.join(pattern, name) for name in os.listdir(pattern)] if os.path.isdir(pattern) else glob.glob(pattern)
+    return sorted(path for path in paths
+                  if os.path.isfile(path) and path.lower().endswith(INPUT_EXTENSIONS)
+                  and not os.path.splitext(path)[0].endswith('_PubChem') and not os.path.basename(path).startswith('~$'))
+
+# Functions to open the local cache and index selected on the command line, and to close them with a summary
+# Directory of the temporary cache used by a --chunksize run without a cache; removed by close_stores
+_temporary_cache_dir = None
+
+def open_stores(args):
+    global _temporary_cache_dir
+    if args.cache or CACHE_PATH:
+        open_cache(args.cache)
+        print(f"Using local cache: {_cache.path}")
+        print("-"*150)
+    elif args.chunksize:
+        # The in-memory stores only last for one chunk, so identifiers repeated across chunks would be requested again
+        _temporary_cache_dir = tempfile.mkdtemp(prefix='PubChem_Retriever_')
+        open_cache(os.path.join(_temporary_cache_dir, 'cache.sqlite'))
+        print(f"Using a temporary cache for the chunks: {_cache.path}")
         print("-"*150)
-        print("Processing start time: ", start_time)
-        print("Processing end time: ", datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    if args.index or INDEX_PATH:
+        open_index(args.index)
+        print(f"Using local index: {_index.path}")
+        print("-"*150)
+
+def close_stores():
+    global _temporary_cache_dir
+    if _cache is not None:
+        print(f"Local cache: {_cache.hits} hits, {_cache.misses} misses")
+        print("-"*150)
+        close_cache()
+    if _temporary_cache_dir is not None:
+        shutil.rmtree(_temporary_cache_dir, ignore_errors=True)
+        _temporary_cache_dir = None
+    if _index is not None:
+        print(f"Local index: {_index.hits} hits, {_index.misses} misses")
+        print("-"*150)
+        close_index()
+
+# A function to process a batch of input files together
+def run_batch(args, options, interactive, pattern):
+    """
+    Read every input file of the batch, look up the identifiers of all files together with retrieve_files,
+    and write one <input>_PubChem.xlsx per input file, next to it or in the --output directory.
+    """
+    if args.chunksize or args.shards:
+        print("--chunksize and --shards cannot be combined with a batch of input files.\n" + "!"*150)
+        return 1
+    paths = find_input_files(pattern)
+    if not paths:
+        print(f"No .xlsx, .csv or .txt input files found in: {pattern}\n" + "!"*150)
+        return 1
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+
+    tables, output_paths = [], []
+    for path in paths:
+        try:
+            df = read_input(path, sep=args.sep)
+        except ValueError as e:
+            print(f"{e} Skipping {path}.\n" + "!"*150)
+            continue
+        if 'Name' not in df.columns and 'InChIKey' not in df.columns:
+            print(f"Neither 'Name' nor 'InChIKey' column found. Skipping {path}.\n" + "!"*150)
+            continue
+        base = os.path.splitext(path)[0]
+        tables.append(df)
+        output_paths.append(os.path.join(args.output, f"{os.path.basename(base)}_PubChem.xlsx") if args.output
+                            else f"{base}_PubChem.xlsx")
+        print(f"{path}: {len(df)} rows")
+    print("-"*150)
+    if not tables:
+        return 1
+
+    if options.input_column is None and interactive and any('Name' in df.columns and 'InChIKey' in df.columns for df in tables):
+        options.input_column = prompt_input_column()
+
+    try:
+        open_stores(args)
+    except ValueError as e:
+        close_stores()
+        print(f"{e}\n" + "!"*150)
+        return 1
+
+    # One checkpoint for the whole batch, since lookups are shared by all files
+    checkpoint_dir = args.output or os.path.dirname(paths[0])
+    checkpoint_path = os.path.join(checkpoint_dir, "PubChem_batch.checkpoint.jsonl")
+    checkpoint = Checkpoint(checkpoint_path, resume=args.resume, options=options)
+    if checkpoint.results:
+        print(f"Resuming from checkpoint: {len(checkpoint.results)} lookups already done ({checkpoint_path})")
         print("-"*150)
-        print(150*"-")
+    try:
+        results = retrieve_files(tables, options, checkpoint=checkpoint)
+    except ValueError as e:
+        print(f"{e} Exiting.\n" + "!"*150)
+        checkpoint.close(remove=True)
+        return 1
+    finally:
+        close_stores()
+
+    for df, path in zip(results, output_paths):
+        write_output(df, path)
+    checkpoint.close(remove=True)
+    print(f"{len(results)} files processed.")
+    print("Processing end time: ", datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    print("-"*150)
+    return 0
+
+# A function to name the intermediate file of a shard
+def shard_path(processed_path, shard, shards):
+    return f"{os.path.splitext(processed_path)[0]}.shard{shard}of{shards}.pkl"
+
+# A function to run every shard in its own process on this machine
+def run_shard_processes(args, options, file_path, processed_path):
+    """
+    Start one process per shard with the same options and wait for all of them; each writes its log next to
+    its intermediate file. Returns True if every shard finished.
+    """
+    flags = [f"--{flag}" for flag in ('inchikey', 'cas', 'smiles', 'dtxsid', 'uses', 'classyfire') if getattr(options, flag)]
+    if not flags:
+        # Without a data flag, every shard would ask for the options on a stdin nobody answers
+        print("No data selected to retrieve; select at least one option to run shards.\n" + "!"*150)
+        return False
+    command = [sys.executable, os.path.abspath(__file__), file_path, '-o', processed_path,
+               '--shards', str(args.shards), '--shard-by', args.shard_by]
+    command += flags
+    if options.input_column:
+        command += ['--input-column', options.input_column]
+    for name in ('sep', 'cache', 'index'):
+        if getattr(args, name):
+            command += [f"--{name}", getattr(args, name)]
+    if args.resume:
+        command.append('--resume')
+
+    processes = []
+    for shard in range(args.shards):
+        log_path = f"{os.path.splitext(shard_path(processed_path, shard, args.shards))[0]}.log"
+        log = open(log_path, 'w', encoding='utf-8')
+        processes.append((shard, subprocess.Popen(command + ['--shard', str(shard)], stdout=log, stderr=subprocess.STDOUT),
+                          log, log_path))
+        print(f"Shard {shard} started, log: {log_path}")
+    print("-"*150)
+
+    failed = []
+    for shard, process, log, log_path in processes:
+        if process.wait() != 0:
+            failed.append(shard)
+        log.close()
+        if shard not in failed:
+            os.remove(log_path)
+    if failed:
+        print(f"Shards {', '.join(map(str, failed))} failed; see their logs, and rerun them with --shard K --resume.\n" + "!"*150)
+        return False
+    print(f"All {args.shards} shards done.")
+    print("-"*150)
+    return True
+
+# A function to run the retriever with the parsed command-line arguments
+def run(args):
+    if args.build_index:
+        if not (args.cid_inchikey or args.cid_smiles or args.cid_synonym):
+            print("--build-index needs at least one of --cid-inchikey, --cid-smiles and --cid-synonym.\n" + "!"*150)
+            return 1
+        build_local_index(args.build_index, args.cid_inchikey, args.cid_smiles, args.cid_synonym)
+        return 0
+
+    # Ask for the data retrieval options unless they were given on the command line
+    flags = ['inchikey', 'cas', 'smiles', 'dtxsid', 'uses', 'classyfire']
+    interactive = not args.all and not any(getattr(args, flag) for flag in flags)
+    if interactive:
+        options = prompt_options()
     else:
-        print(150*"!")
-        print("No file selected.")
-        print(150*"!")
+        options = RetrievalOptions(**{flag: args.all or getattr(args, flag) for flag in flags})
+    options.input_column = args.input_column
+
+    if (args.shard is not None or args.merge) and not args.shards:
+        print("--shard and --merge need --shards.\n" + "!"*150)
+        return 1
+    if args.shards:
+        if args.chunksize:
+            print("--chunksize cannot be combined with --shards.\n" + "!"*150)
+            return 1
+        if args.shards < 1 or (args.shard is not None and not 0 <= args.shard < args.shards):
+            print(f"--shard must be between 0 and {args.shards - 1}.\n" + "!"*150)
+            return 1
+    if args.shard is not None:
+        # Every shard gets its share of the request rates, so that all shards together stay within them
+        share_rate_limits(args.shards)
+
+    print("-"*150)
+    start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print("Processing start time: ", start_time)
+    print("-"*150)
+
+    file_path = args.input or choose_input_file()
+    if file_path and is_batch_input(file_path):
+        return run_batch(args, options, interactive, file_path)
+    if not file_path or not os.path.exists(file_path):
+        print("No valid file selected or path does not exist.\n" + "!" * 150)
+        return 1
+
+    try:
+        if args.merge:
+            # The shards already hold the input rows
+            df = None
+        elif args.chunksize:
+            chunks = iter_input_chunks(file_path, args.chunksize, sep=args.sep)
+            df = next(chunks, None)
+            if df is None:
+                raise ValueError("The input file has no rows.")
+        else:
+            df = read_input(file_path, sep=args.sep)
+    except ValueError as e:
+        print(f"{e}\n" + "!"*150)
+        return 1
+
+    # Decide input mode
+    if options.input_column is None and interactive and df is not None and 'Name' in df.columns and 'InChIKey' in df.columns:
+        options.input_column = prompt_input_column()
+
+    base, ext = os.path.splitext(file_path)
+    processed_path = args.output or f"{base}_PubChem.xlsx"
+    shard_paths = [shard_path(processed_path, shard, args.shards) for shard in range(args.shards or 0)]
+
+    # Run all shards in parallel processes, then merge them below
+    if args.shards and args.shard is None and not args.merge:
+        df = None
+        if not run_shard_processes(args, options, file_path, processed_path):
+            return 1
+        args.merge = True
+
+    try:
+        open_stores(args)
+    except ValueError as e:
+        close_stores()
+        print(f"{e}\n" + "!"*150)
+        return 1
+
+    # Lookups are checkpointed next to the output file, so that an interrupted run can be resumed
+    output_base = os.path.splitext(shard_paths[args.shard] if args.shard is not None else processed_path)[0]
+    checkpoint_path = f"{output_base}.checkpoint.jsonl"
+    checkpoint = Checkpoint(checkpoint_path, resume=args.resume, options=options)
+    if checkpoint.results:
+        print(f"Resuming from checkpoint: {len(checkpoint.results)} lookups already done ({checkpoint_path})")
+        print("-"*150)
+
+    try:
+        if args.merge:
+            df = merge_shards(shard_paths, options)
+        elif args.shard is not None:
+            df = retrieve_shard(df, options, args.shards, args.shard, by=args.shard_by, checkpoint=checkpoint)
+        elif args.chunksize:
+            # Process the input chunk by chunk, appending each chunk to the output as soon as it is done
+            writer = open_output_writer(processed_path)
+            rows_done = 0
+            for n, chunk in enumerate(itertools.chain([df], chunks), start=1):
+                writer.append(retrieve(chunk, options, checkpoint=checkpoint))
+                rows_done += len(chunk)
+                print(f"Chunk {n} done: {rows_done} rows written to {processed_path}")
+                print("-"*150)
+            writer.close()
+        else:
+            df = retrieve(df, options, checkpoint=checkpoint)
+    except ValueError as e:
+        print(f"{e} Exiting.\n" + "!"*150)
+        checkpoint.close(remove=True)
+        return 1
+    finally:
+        close_stores()
+
+    # Save results
+    if args.shard is not None:
+        df.to_pickle(shard_paths[args.shard])
+        print(f"Shard {args.shard} saved to: {shard_paths[args.shard]}")
+        print("-"*150)
+    elif not args.chunksize:
+        write_output(df, processed_path)
+    if args.merge:
+        for path in shard_paths:
+            os.remove(path)
+
+    # The output is complete, so the checkpoint is no longer needed
+    checkpoint.close(remove=True)
+
+    print("Processing start time: ", start_time)
+    print("Processing end time: ", datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    print("-"*150)
+    print(150*"-")
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,336 @@
+# Benchmark of PubChem_Retriever.py against a local stand-in for the PubChem and ClassyFire services
+# Runs the command-line retrieval path (main) over synthetic inputs and reports rows/s, requests per row,
+# peak memory, and output-write time, without sending a single request to the real services
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+# Default benchmark sizes, in input rows
+BENCHMARK_ROWS = [100, 10000, 100000]
+
+# Synthetic input: fraction of rows repeating an earlier compound, and fraction of names PubChem does not know
+DUPLICATE_FRACTION = 0.5
+UNKNOWN_FRACTION = 0.05
+
+# A function to derive a stable CID from an identifier
+def synthetic_cid(identifier):
+    return int(hashlib.md5(identifier.strip().upper().encode()).hexdigest()[:7], 16) + 1
+
+# A function to derive a stable InChIKey-shaped key from a CID
+def synthetic_inchikey(cid):
+    h = hashlib.md5(str(cid).encode()).hexdigest().upper()
+    return f"{h[:14]}-{h[14:24]}-N"
+
+# A function to build a synthetic PUG-View record with the headings the retriever extracts
+def synthetic_record(cid, heading=None, padding=2000):
+    def section(name, strings):
+        return {"TOCHeading": name, "Information": [{"Value": {"StringWithMarkup": [{"String": s} for s in strings]}}]}
+
+    sections = [
+        {"TOCHeading": "Names and Identifiers", "Section": [
+            {"TOCHeading": "Other Identifiers", "Section": [
+                section("CAS", [f"{cid % 9999999}-{cid % 90 + 10}-{cid % 10}"]),
+                section("DSSTox Substance ID", [f"DTXSID{cid}"]),
+            ]},
+        ]},
+        {"TOCHeading": "Use and Manufacturing", "Section": [
+            section("Uses", ["Industrial solvent", "Laboratory reagent"]),
+            section("Use Classification", ["Hazard Classes and Categories"]),
+        ]},
+        # Stands in for the spectra, literature and patent sections that make real records large
+        section("Other Data", ["x" * padding]),
+    ]
+    if heading:
+        stack = list(sections)
+        while stack:
+            s = stack.pop()
+            if s.get("TOCHeading") == heading:
+                return {"Record": {"RecordNumber": cid, "Section": [s]}}
+            stack.extend(s.get("Section", []))
+        return None
+    return {"Record": {"RecordNumber": cid, "Section": sections}}
+
+# An HTTP server that stays quiet when a client drops a keep-alive connection, as the retriever's pool does on exit
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+# A stand-in for PUG REST, PUG-View, and ClassyFire
+class MockServer:
+    """
+    Local HTTP server answering the requests PubChem_Retriever.py sends. Responses are synthetic unless a recorded
+    response for the same method and path (and POST form) is found in the replay file, a JSONL file of
+    {"method", "path", "data", "status", "body"} objects. latency (seconds) is added to every response,
+    error_rate is the fraction of requests answered with 503 Server Busy, and throttle is the status reported
+    in the X-Throttling-Control header.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, throttle='Green', replay=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.recorded = {}
+        if replay:
+            with open(replay, encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    key = (entry['method'].upper(), entry['path'], entry.get('data') or '')
+                    self.recorded[key] = (entry['status'], entry['body'])
+        self.counts = {}
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self, 'GET', '')
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                server.handle(self, 'POST', self.rfile.read(length).decode())
+
+        self.httpd = QuietHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_counts(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def handle(self, handler, method, data):
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.count('errors')
+            return self.send(handler, 503, {"Fault": {"Code": "PUGREST.ServerBusy"}})
+        status, body, kind = self.respond(method, handler.path, data)
+        self.count(kind)
+        self.send(handler, status, body)
+
+    def send(self, handler, status, obj):
+        body = json.dumps(obj).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.send_header('X-Throttling-Control', f"Request Count status: {self.throttle} (10%), "
+                                                    f"Request Time status: Green (10%), Service status: Green (10%)")
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def respond(self, method, raw_path, data):
+        url = urlparse(raw_path)
+        path, query = unquote(url.path), parse_qs(url.query)
+        not_found = {"Fault": {"Code": "PUGREST.NotFound"}}
+
+        m = re.match(r"/rest/pug/compound/(name|inchikey)/(.+)/cids/JSON$", path)
+        kind = 'cids' if m else 'property' if '/property/' in path else 'pug_view' if path.startswith('/rest/pug_view') \
+            else 'classyfire' if path.startswith('/entities') else 'other'
+        recorded = self.recorded.get((method, raw_path, data))
+        if recorded is not None:
+            return recorded[0], recorded[1], kind
+
+        if m:
+            if m.group(2).lower().startswith('unknown'):
+                return 404, not_found, kind
+            return 200, {"IdentifierList": {"CID": [synthetic_cid(m.group(2))]}}, kind
+
+        m = re.match(r"/rest/pug/compound/(inchikey|cid)/?(.*?)/?property/[^/]+/JSON$", path)
+        if m:
+            namespace, ids = m.group(1), m.group(2) or parse_qs(data).get(m.group(1), [''])[0]
+            properties = []
+            for value in filter(None, ids.split(',')):
+                if namespace == 'inchikey':
+                    if value.lower().startswith('unknown'):
+                        continue
+                    cid = synthetic_cid(value)
+                else:
+                    cid = int(value)
+                properties.append({"CID": cid, "InChIKey": value if namespace == 'inchikey' else synthetic_inchikey(cid),
+                                   "SMILES": f"C{cid}"})
+            if not properties:
+                return 404, not_found, kind
+            return 200, {"PropertyTable": {"Properties": properties}}, kind
+
+        m = re.match(r"/rest/pug_view/data/compound/(\d+)/JSON$", path)
+        if m:
+            record = synthetic_record(int(m.group(1)), query.get('heading', [None])[0])
+            if record is None:
+                return 404, {"Fault": {"Code": "PUGVIEW.NotFound"}}, kind
+            return 200, record, kind
+
+        m = re.match(r"/entities/([A-Z0-9-]+)\.json$", path)
+        if m:
+            return 200, {"inchikey": f"InChIKey={m.group(1)}", "kingdom": {"name": "Organic compounds"},
+                         "superclass": {"name": "Benzenoids"}, "class": {"name": "Benzene and substituted derivatives"},
+                         "subclass": None, "intermediate_nodes": [], "direct_parent": {"name": "Benzene"}}, kind
+        return 400, {"Fault": {"Code": "PUGREST.BadRequest"}}, kind
+
+# A function to write a synthetic input table
+def write_synthetic_input(path, rows, seed=0):
+    """
+    Write a tab-separated input with Name and InChIKey columns, where DUPLICATE_FRACTION of the rows repeat an
+    earlier compound and UNKNOWN_FRACTION of the names are not found, so that the InChIKey fallback is exercised.
+    """
+    rng = random.Random(seed)
+    unique = max(1, int(rows * (1 - DUPLICATE_FRACTION)))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("Name\tInChIKey\n")
+        for i in range(rows):
+            n = i if i < unique else rng.randrange(unique)
+            name = f"unknown compound {n}" if n % int(1 / UNKNOWN_FRACTION) == 0 else f"compound {n}"
+            f.write(f"{name}\t{synthetic_inchikey(synthetic_cid(f'compound {n}'))}\n")
+
+# A function to run one benchmark in this process; called in a fresh child process for each size
+def run_child(args):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import resource
+    import contextlib
+    import PubChem_Retriever as retriever
+
+    base_url = os.environ['BENCHMARK_URL']
+    retriever.PUG_REST_URL = f"{base_url}/rest/pug"
+    retriever.PUG_VIEW_URL = f"{base_url}/rest/pug_view"
+    retriever.CLASSYFIRE_URL = base_url + "/entities/{inchikey}.json"
+    if not args.rate_limits:
+        # Measure the retrieval path itself rather than the published request rates
+        retriever._pubchem_limiter = retriever.RateLimiter([(10 ** 9, 1)])
+        retriever._classyfire_limiter = retriever.RateLimiter([(10 ** 9, 1)])
+    retriever.RETRY_BACKOFF = args.retry_backoff
+
+    # Time every output write
+    write_time = [0.0]
+    open_output_writer = retriever.open_output_writer
+
+    class TimedWriter:
+        def __init__(self, writer):
+            self.writer = writer
+
+        def append(self, df):
+            start = time.perf_counter()
+            self.writer.append(df)
+            write_time[0] += time.perf_counter() - start
+
+        def close(self):
+            start = time.perf_counter()
+            self.writer.close()
+            write_time[0] += time.perf_counter() - start
+
+    retriever.open_output_writer = lambda path: TimedWriter(open_output_writer(path))
+
+    argv = [args.input, '-o', args.output, '--input-column', 'name'] + args.flags.split()
+    if args.chunksize:
+        argv += ['--chunksize', str(args.chunksize)]
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        status = retriever.main(argv)
+    elapsed = time.perf_counter() - start
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_mb = rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+    totals = retriever.METRICS.totals()
+    print(json.dumps({'status': status, 'seconds': elapsed, 'write_seconds': write_time[0], 'peak_rss_mb': peak_mb,
+                      'retried': totals['retried'], 'failed': totals['failed']}))
+
+# A function to run the benchmark for one input size
+def run_benchmark(server, rows, args, work_dir):
+    input_path = os.path.join(work_dir, f"input_{rows}.txt")
+    output_path = os.path.join(work_dir, f"output_{rows}.{args.format}")
+    write_synthetic_input(input_path, rows, seed=args.seed)
+    server.reset_counts()
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--input', input_path, '--output', output_path,
+               f'--flags={args.flags}', '--retry-backoff', str(args.retry_backoff)]
+    if args.chunksize:
+        command += ['--chunksize', str(args.chunksize)]
+    if args.rate_limits:
+        command.append('--rate-limits')
+    child = subprocess.run(command, capture_output=True, text=True, env={**os.environ, 'BENCHMARK_URL': server.url})
+    if child.returncode != 0:
+        raise RuntimeError(f"Benchmark run for {rows} rows failed:\n{child.stderr}")
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+    counts = server.reset_counts()
+    result.update(rows=rows, requests=sum(v for k, v in counts.items() if k != 'errors'), errors=counts.get('errors', 0),
+                  counts=counts)
+    return result
+
+# A function to parse the command line
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark PubChem_Retriever.py against a local mock PubChem/ClassyFire server.")
+    parser.add_argument('--rows', type=int, nargs='+', default=BENCHMARK_ROWS, help="input sizes to benchmark")
+    parser.add_argument('--flags', default='--all', help="retrieval flags passed to PubChem_Retriever.py (default: --all)")
+    parser.add_argument('--format', choices=['xlsx', 'csv', 'parquet'], default='xlsx', help="output format")
+    parser.add_argument('--chunksize', type=int, help="stream the input in chunks of this many rows")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every mock response")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument('--throttle', default='Green', choices=['Green', 'Yellow', 'Red', 'Black'],
+                        help="status reported in the X-Throttling-Control header")
+    parser.add_argument('--replay', metavar='FILE', help="JSONL file of recorded responses to serve instead of synthetic ones")
+    parser.add_argument('--rate-limits', action='store_true', help="keep the published PubChem and ClassyFire request rates")
+    parser.add_argument('--retry-backoff', type=float, default=0.01, help="base retry delay in seconds (default: 0.01)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic input")
+    parser.add_argument('--json', metavar='FILE', help="also save the results as JSON")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--input', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        run_child(args)
+        return 0
+
+    server = MockServer(latency=args.latency, error_rate=args.error_rate, throttle=args.throttle, replay=args.replay).start()
+    print(f"Mock PubChem/ClassyFire server at {server.url}, latency {args.latency}s, error rate {args.error_rate}, "
+          f"throttling status {args.throttle}")
+    print("-"*150)
+    print(f"{'Rows':>10} {'Seconds':>10} {'Rows/s':>10} {'Requests/row':>14} {'Errors':>8} {'Retried':>8} "
+          f"{'Failed':>8} {'Peak RSS MB':>12} {'Write s':>10}")
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for rows in args.rows:
+                r = run_benchmark(server, rows, args, work_dir)
+                results.append(r)
+                print(f"{rows:>10} {r['seconds']:>10.2f} {rows / r['seconds']:>10.1f} {r['requests'] / rows:>14.3f} "
+                      f"{r['errors']:>8} {r['retried']:>8} {r['failed']:>8} {r['peak_rss_mb']:>12.1f} {r['write_seconds']:>10.2f}")
+    finally:
+        server.stop()
+    print("-"*150)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to: {args.json}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())